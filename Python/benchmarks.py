@@ -1,172 +1,507 @@
 import interface as iff
+from config import RingConfig
+from columns import RecordSchema
+from stats import percentile
 from time import perf_counter
+import argparse
+import csv
+import json
+import os
 import random
-from main import KS
-import matplotlib.pyplot as plt
+import sys
+import tracemalloc
 
+# Key size (bits)
+KS = 32
 HS = 2**KS
 
-def benchmark(NC: int, results: dict) -> dict:
-    interface = iff.Interface()
+OPERATIONS = [
+    "Insert key",
+    "Update key",
+    "Delete key",
+    "Key lookup",
+    "Node Join",
+    "Node Leave",
+    "Exact match",
+    "Range Query",
+    "kNN Query",
+    "Massive Nodes' failure",
+]
 
-    # Build network with NC nodes
-    build_start = perf_counter()
+def load_items(filename: str, size: int = None) -> list[tuple]:
+    """Items of the csv. If size is bigger than the file, the records
+    are repeated under suffixed keys, so data sweeps aren't capped
+    by the dataset."""
+
+    items = list(iff.parse_csv(filename).items())
+    if size is None:
+        return items
+    copies = [items]
+    copy = 1
+    while len(items) * copy < size:
+        copies.append([(f"{key}#{copy}", record) for key, record in items])
+        copy += 1
+    return [item for batch in copies for item in batch][:size]
+
+def time_calls(call, args: list, warmup: int) -> list[float]:
+    """Runs call(arg) for every arg and returns each call's time (ms).
+    The first warmup args are run untimed."""
+
+    for arg in args[:warmup]:
+        call(arg)
+    samples = []
+    for arg in args[warmup:]:
+        start = perf_counter()
+        call(arg)
+        samples.append((perf_counter() - start) * 1000)
+    return samples
+
+def summarize(samples: list[float]) -> dict:
+    values = sorted(samples)
+    return {
+        "samples": len(values),
+        "mean_ms": sum(values) / len(values),
+        "median_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "min_ms": values[0],
+    }
+
+def benchmark(NC: int, items: list[tuple], repeat: int = 100, warmup: int = 10,
+              operations: list[str] = OPERATIONS) -> dict:
+    """Times every operation repeat times (after warmup untimed runs)
+    on a network of NC nodes holding items.
+    Returns {operation: samples in ms}."""
+
+    interface = iff.Interface(RingConfig(ks=KS))
     interface.build_network(NC)
-    build_end = perf_counter()
+    interface.insert_all_data(items)
+    first_node = interface.get_node()
+    runs = warmup + repeat
+    samples = {}
+
+    in_keys = [f"In key {i}" for i in range(runs)]
+    if "Insert key" in operations:
+        print("Benchmarking insert key...")
+        samples["Insert key"] = time_calls(
+            lambda key: interface.insert_item((key, f"In data {key}"), first_node.id), in_keys, warmup)
+    else:
+        interface.insert_items([(key, f"In data {key}") for key in in_keys])
+
+    if "Update key" in operations:
+        print("Benchmarking Update record based on key...")
+        samples["Update key"] = time_calls(
+            lambda key: interface.update_record((key, f"Updata {key}"), first_node.id), in_keys, warmup)
+
+    if "Delete key" in operations:
+        print("Benchmarking Delete key...")
+        samples["Delete key"] = time_calls(
+            lambda key: interface.delete_item(key=key, start_node_id=first_node.id), in_keys, warmup)
+
+    search_keys = [random.randrange(HS) for _ in range(runs)]
+    if "Key lookup" in operations:
+        print("Benchmarking Key lookup...")
+        samples["Key lookup"] = time_calls(first_node.find_successor, search_keys, warmup)
+
+    # Node ids not in the network, and nodes to leave or match
+    join_nodes = set()
+    while len(join_nodes) < runs:
+        node_id = random.randrange(HS)
+        if node_id not in interface.nodes:
+            join_nodes.add(node_id)
+    join_nodes = sorted(join_nodes)
+    # Leaves and matches can't outnumber the nodes
+    member_runs = min(runs, NC // 2)
+    random_nodes = random.sample(interface.sorted_ids, member_runs * 2)
+    (leave_n, ex_match_n) = (random_nodes[:member_runs], random_nodes[member_runs:])
+    member_warmup = min(warmup, member_runs // 2)
+
+    if "Node Join" in operations:
+        print("Benchmarking Node join...")
+        samples["Node Join"] = time_calls(lambda key: interface.node_join(new_node_id=key), join_nodes, warmup)
+
+    if "Exact match" in operations:
+        print("Benchmarking Exact match...")
+        samples["Exact match"] = time_calls(lambda key: interface.exact_match(key=key), ex_match_n, member_warmup)
+
+    if "Node Leave" in operations:
+        print("Benchmarking Node Leave...")
+        samples["Node Leave"] = time_calls(interface.node_leave, leave_n, member_warmup)
 
-    # Insert all data to the network
-    data_start = perf_counter()
+    if "Range Query" in operations:
+        print("Benchmarking Range query...")
+        samples["Range Query"] = time_calls(
+            lambda key: interface.range_query(key, (key + HS//20) % HS), search_keys, warmup)
+
+    if "kNN Query" in operations:
+        print("Benchmarking kNN query...")
+        knn_nodes = [random.choice(interface.sorted_ids) for _ in range(runs)]
+        samples["kNN Query"] = time_calls(lambda key: interface.knn(5, key), knn_nodes, warmup)
+
+    # Destroys the network, so every run gets a fresh one
+    if "Massive Nodes' failure" in operations:
+        print("Benchmarking Massive Nodes' failure...")
+        samples["Massive Nodes' failure"] = []
+        for run in range(runs):
+            network = iff.Interface(RingConfig(ks=KS))
+            network.build_network(NC, bulk=True)
+            network.insert_all_data(items)
+            start = perf_counter()
+            network.fail_nodes(0.1)
+            network.heal()
+            if run >= warmup:
+                samples["Massive Nodes' failure"].append((perf_counter() - start) * 1000)
+
+    return samples
+
+def benchmark_all(node_counts: list[int] = range(20, 301, 40), data_sizes: list[int] = [None],
+                  repeat: int = 100, warmup: int = 10, seed: int = 0, data_file: str = "NH4_NO3.csv",
+                  operations: list[str] = OPERATIONS) -> list[dict]:
+    """Runs benchmark for every (data size, node count) pair.
+    Returns one row of summary statistics per operation and pair."""
+
+    rows = []
+    for size in data_sizes:
+        items = load_items(data_file, size)
+        for NC in node_counts:
+            print(f"\nBenchmarking {NC} nodes, {len(items)} items...\n")
+            # Every configuration gets the same random choices
+            random.seed(seed)
+            samples = benchmark(NC, items, repeat, warmup, operations)
+            for operation in operations:
+                # No samples when e.g. the ring is too small to leave nodes
+                if samples[operation]:
+                    rows.append({"operation": operation, "nodes": NC, "items": len(items),
+                                 **summarize(samples[operation])})
+    return rows
+
+def benchmark_knn(NC: int, items: list[tuple], k_values: list[int], repeat: int = 100,
+                  warmup: int = 10) -> list[dict]:
+    """Times node and item kNN queries around random keys for
+    every k, on a network of NC nodes holding items.
+    Returns one summary row per query type and k."""
+
+    interface = iff.Interface(RingConfig(ks=KS))
+    interface.build_network(NC, bulk=True)
+    interface.insert_all_data(items)
+    keys = [random.randrange(HS) for _ in range(warmup + repeat)]
+
+    rows = []
+    for k in k_values:
+        print(f"Benchmarking kNN with k = {k}...")
+        for operation, query in ((f"kNN Query k={k}", interface.knn),
+                                 (f"kNN items k={k}", interface.knn_items)):
+            samples = time_calls(lambda key: query(k, key), keys, warmup)
+            rows.append({"operation": operation, "nodes": NC, "items": len(items), **summarize(samples)})
+    return rows
+
+def benchmark_memory(NC: int, ks: int = KS) -> float:
+    """Returns the bytes allocated per node for a network of NC nodes
+    without data, as measured by tracemalloc."""
+
+    node_ids = set()
+    while len(node_ids) < NC:
+        node_ids.add(random.randrange(2**ks))
+
+    tracemalloc.start()
+    interface = iff.Interface(RingConfig(ks=ks))
+    interface.build_network(NC, list(node_ids))
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return allocated / NC
+
+def benchmark_cache(NC: int, cache_size: int, reads: int = 10000) -> dict:
+    """Times skewed (1/rank weighted) reads of the csv keys
+    with the given location cache size. Returns ms per read
+    and the cache counters."""
+
+    interface = iff.Interface(RingConfig(ks=KS), cache_size=cache_size)
+    interface.build_network(NC)
     items = iff.parse_csv("NH4_NO3.csv")
     interface.insert_all_data(items.items())
-    data_end = perf_counter()
 
-    # Generate random numbers to use for benchmarking
-    run_count = 10
-    random_nodes = random.sample(sorted(interface.nodes), run_count*2)
-    (leave_n, ex_match_n) = (random_nodes[:run_count], random_nodes[run_count:])
+    keys = list(items)
+    weights = [1 / rank for rank in range(1, len(keys) + 1)]
+    read_keys = random.choices(keys, weights, k=reads)
 
-    search_keys = random.sample(range(HS), run_count)
-    first_node = interface.get_node()
+    start = perf_counter()
+    for key in read_keys:
+        interface.get_item(key)
+    end = perf_counter()
 
-    join_nodes = []
-    count = 0
-    for i in range(HS):
-        if i not in interface.nodes:
-            count += 1
-            join_nodes.append(i)
-            if count >= run_count//2:
-                break
-
-    in_keys = []
-    in_data = []
-    up_data = []
-
-    for i in range(run_count):
-        in_keys.append(f"In key {i}")
-        in_data.append(f"In data {i}")
-        up_data.append(f"Updata {i}")
-
-    # Start process benchmarking NC Nodes
-
-    # Insert key
-    print("Benchmarking insert key...")
-    in_key_start = perf_counter()
-    for index, key in enumerate(in_keys):
-        interface.insert_item((key, in_data[index]), first_node.id)
-    in_key_end = perf_counter()
-
-    # Update record based on key
-    print("Benchmarking Update record based on key...")
-    up_key_start = perf_counter()
-    for key in in_keys:
-        interface.update_record((key, up_data[index]), first_node.id)
-    up_key_end = perf_counter()
-
-    # Delete key
-    print("Benchmarking Delete key...")
-    del_key_start = perf_counter()
-    for key in in_keys:
-        interface.delete_item(key=key, start_node_id=first_node.id)
-    del_key_end = perf_counter()
-
-    # Key lookup 
-    print("Benchmarking Key lookup...")
-    query_start = perf_counter()
-    for key in search_keys:
-        first_node.find_successor(key)
-    query_end = perf_counter()
-
-    # Node join
-    print("Benchmarking Node join...")
-    join_start = perf_counter()
-    for key in join_nodes:
-        interface.node_join(new_node_id=key)
-    join_end = perf_counter()
-
-    # Exact match
-    print("Benchmarking Exact match...")
-    ex_match_start = perf_counter()
-    for key in ex_match_n:
-        interface.exact_match(key=key)
-    ex_match_end = perf_counter()
-
-    # Node Leave
-    print("Benchmarking Node Leave...")
-    leave_start = perf_counter()
-    for key in leave_n:
-        interface.node_leave(key)
-    leave_end = perf_counter()
-
-    # Range query
-    print("Benchmarking Range query...")
-    range_start = perf_counter()
-    for key in search_keys:
-        interface.range_query(key, (key+20) % HS )
-    range_end = perf_counter()
-
-    # kNN query
-    print("Benchmarking kNN query...")
-    knn_start = perf_counter()
-    for key in join_nodes:
-        interface.knn(5, key)
-    knn_end = perf_counter()
-
-    #results['Build'][NC] = (build_end - build_start) * 1000
-    #results['Insert all data'][NC] = (data_end - data_start) * 1000
-    results['Insert key'][NC] = (in_key_end - in_key_start) * 1000 / run_count
-    results['Delete key'][NC] = (del_key_end - del_key_start) * 1000 / run_count
-    results['Update key'][NC] = (up_key_end - up_key_start) * 1000 / run_count
-    results['Key lookup'][NC] = (query_end - query_start) * 1000 / run_count
-    results['Node Join'][NC] = (join_end - join_start) * 1000 / (run_count/2)
-    results['Node Leave'][NC] = (leave_end - leave_start) * 1000 / run_count
-    #results['Massive Nodes\' failure'][NC] = (mnn_end - mnn_start)
-    results['Exact match'][NC] = (ex_match_end - ex_match_start) * 1000 / run_count
-    results['Range Query'][NC] = (range_end - range_start) * 1000 / run_count
-    results['kNN Query'][NC] = (knn_end - knn_start) * 1000 / run_count
+    return {"ms_per_read": (end - start) * 1000 / reads, **interface.cache_stats}
+
+def benchmark_replication(NC: int, replicas: int, reads: int = 10000) -> dict:
+    """Skewed (1/rank weighted) reads of the csv keys under every read
+    policy, with each item kept on replicas successors. Returns the
+    per-node read load summary of each policy."""
+
+    items = iff.parse_csv("NH4_NO3.csv")
+    keys = list(items)
+    weights = [1 / rank for rank in range(1, len(keys) + 1)]
+    read_keys = random.choices(keys, weights, k=reads)
+    node_ids = random.sample(range(HS), NC)
+
+    results = {}
+    for policy in iff.READ_POLICIES:
+        interface = iff.Interface(RingConfig(ks=KS, replicas=replicas), read_policy=policy)
+        interface.build_network(NC, node_ids, bulk=True)
+        interface.insert_all_data(items.items())
+        start = perf_counter()
+        for key in read_keys:
+            interface.get_item(key)
+        end = perf_counter()
+        load = interface.read_load()
+        del load["per_node"]
+        results[policy] = {"ms_per_read": (end - start) * 1000 / reads, **load}
     return results
 
-def benchmark_all() -> dict:
-    answer = {
-        #"Build": {},
-        #"Insert all data": {},
-        "Insert key": {},
-        "Delete key": {},
-        "Update key": {},
-        "Key lookup": {},
-        "Node Join": {},
-        "Node Leave": {},
-        #"Massive Nodes' failure": {},
-        "Exact match": {},
-        "Range Query": {},
-        "kNN Query": {}
+def benchmark_placement(NC: int, item_count: int = 100_000, vnode_counts: list[int] = [4, 16]) -> dict:
+    """Items per physical node for NC nodes under random placement
+    (the default), virtual nodes, and load-aware joins that split the
+    most loaded arc, starting from a single node holding every item.
+    Returns the load report of each placement."""
+
+    keys = [f"key {i}" for i in range(item_count)]
+    values = [None] * item_count
+    node_ids = random.sample(range(HS), NC)
+    reports = {}
+
+    interface = iff.Interface(RingConfig(ks=KS))
+    interface.build_network(NC, node_ids, bulk=True)
+    interface.bulk_load(keys, values)
+    reports["random"] = interface.load_report()
+
+    for vnodes in vnode_counts:
+        interface = iff.Interface(RingConfig(ks=KS))
+        interface.build_network(NC, node_ids, bulk=True, vnodes=vnodes)
+        interface.bulk_load(keys, values)
+        reports[f"{vnodes} vnodes"] = interface.load_report()
+
+    interface = iff.Interface(RingConfig(ks=KS))
+    interface.build_network(1, node_ids[:1])
+    interface.bulk_load(keys, values)
+    for _ in range(NC - 1):
+        interface.balanced_join()
+    reports["balanced join"] = interface.load_report()
+    return reports
+
+def benchmark_columnar(NC: int, item_count: int = 100_000) -> dict:
+    """Memory per item and "mean Soil_NH4 per Experimental_treatment"
+    time, with dict records pulled to the client vs columnar records
+    aggregated on the nodes. The csv records are repeated under new
+    keys up to item_count items."""
+
+    records = list(iff.parse_csv("NH4_NO3.csv").values())
+    keys = [f"record {i}" for i in range(item_count)]
+    values = [dict(records[i % len(records)]) for i in range(item_count)]
+    node_ids = random.sample(range(HS), NC)
+    results = {}
+    for layout, schema in (("dict", None), ("columnar", RecordSchema())):
+        tracemalloc.start()
+        interface = iff.Interface(RingConfig(ks=KS, schema=schema))
+        interface.build_network(NC, node_ids, bulk=True)
+        before = tracemalloc.get_traced_memory()[0]
+        interface.bulk_load(keys, [dict(value) for value in values])
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        start = perf_counter()
+        sums = {}
+        for _, _, record in interface.walk_items(0, HS - 1):
+            group = sums.setdefault(record["Experimental_treatment"], [0, 0.0])
+            group[0] += 1
+            group[1] += record["Soil_NH4"]
+        client = perf_counter() - start
+        start = perf_counter()
+        interface.aggregate("Soil_NH4", "Experimental_treatment")
+        pushed = perf_counter() - start
+        results[layout] = {
+            "bytes_per_item": allocated / item_count,
+            "client_aggregate_ms": client * 1000,
+            "node_aggregate_ms": pushed * 1000,
+        }
+    return results
+
+def benchmark_failure(NC: int, fraction: float, lookups: int = 200, items: list[tuple] = ()) -> dict:
+    """Crashes a fraction of NC nodes and measures the lookup success
+    rate and extra hops before repair, and the stabilization rounds
+    and time needed until the ring is consistent again."""
+
+    interface = iff.Interface(RingConfig(ks=KS))
+    interface.build_network(NC, bulk=True)
+    interface.insert_all_data(items)
+    keys = [random.randrange(HS) for _ in range(lookups)]
+    hops_before = sum(interface.get_node().route(key)[1] for key in keys) / lookups
+
+    interface.fail_nodes(fraction)
+    succeeded = 0
+    hops_after = 0
+    for key in keys:
+        node, hops = interface.get_node().route(key)
+        hops_after += hops
+        if node is not None and node.id == interface.successor_id(key):
+            succeeded += 1
+
+    heal_start = perf_counter()
+    rounds = interface.heal()
+    heal_end = perf_counter()
+
+    return {
+        "success_rate": succeeded / lookups,
+        "hops_before": hops_before,
+        "hops_after": hops_after / lookups,
+        "extra_hops": hops_after / lookups - hops_before,
+        "heal_rounds": rounds,
+        "heal_ms": (heal_end - heal_start) * 1000,
     }
-    for i in range(20, 301, 40):
-        print(f"\nBenchmarking {i} nodes...\n")
-        answer = benchmark(i, answer)
-    return answer
-
-def results_print(results: dict) -> None:
-    for process in results.items():
-        print(f"\n{process[0]} times:")
-        for node_count, time in process[1].items():
-            print(f"{process[0]} time for {node_count} nodes: {time}")
-
-def plot_results(results: dict) -> dict[plt.plot]:
-    # X axis = Node count, Y axis = Time
-    plots = {}
-    for process in results.items():
-        plt.figure(process[0])
-        plots[process[0]] = plt.plot([nc[0] for nc in process[1].items()],\
-            [t[1] for t in process[1].items()])
-        if process[0] != "Node Join" and process[0] != "Node Leave":
-            plt.axis([20, 300, 0, 0.1])
+
+def benchmark_failures(NC: int, items: list[tuple], fractions: list[float], repeat: int = 100,
+                       warmup: int = 10) -> list[dict]:
+    """benchmark_failure for every failure fraction, repeated on fresh
+    networks of NC nodes holding items. One row per fraction: the time
+    to heal summarized like the other operations, plus the mean lookup
+    success rate, extra hops and stabilization rounds."""
+
+    rows = []
+    for fraction in fractions:
+        print(f"Benchmarking failure of {fraction:.0%} of the nodes...")
+        runs = [benchmark_failure(NC, fraction, items=items) for _ in range(warmup + repeat)][warmup:]
+        rows.append({
+            "operation": f"Failure {fraction:.0%}",
+            "nodes": NC,
+            "items": len(items),
+            **summarize([run["heal_ms"] for run in runs]),
+            "success_rate": sum(run["success_rate"] for run in runs) / len(runs),
+            "extra_hops": sum(run["extra_hops"] for run in runs) / len(runs),
+            "heal_rounds": sum(run["heal_rounds"] for run in runs) / len(runs),
+        })
+        print(f"  success rate {rows[-1]['success_rate']:.1%}, extra hops {rows[-1]['extra_hops']:.2f}, "
+              f"heal rounds {rows[-1]['heal_rounds']:.1f}")
+    return rows
+
+def results_print(rows: list[dict]) -> None:
+    print(f"\n{'Operation':<24}{'Nodes':>7}{'Items':>8}{'Median':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for row in rows:
+        print(f"{row['operation']:<24}{row['nodes']:>7}{row['items']:>8}"
+              f"{row['median_ms']:>10.4f}{row['p95_ms']:>10.4f}{row['p99_ms']:>10.4f}")
+
+def save_json(rows: list[dict], config: dict, filename: str) -> None:
+    with open(filename, "w") as f:
+        json.dump({"config": config, "results": rows}, f, indent=2)
+
+def save_csv(rows: list[dict], filename: str) -> None:
+    with open(filename, "w", newline="") as f:
+        # Some rows (e.g. failure sweeps) have extra columns
+        fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+
+def compare(rows: list[dict], baseline_file: str, threshold: float = 0.2) -> list[dict]:
+    """Compares medians with a saved JSON run. Returns the rows whose
+    median is more than threshold (fraction) slower than the baseline."""
+
+    with open(baseline_file) as f:
+        baseline = {(row["operation"], row["nodes"], row["items"]): row for row in json.load(f)["results"]}
+
+    slower = []
+    for row in rows:
+        old = baseline.get((row["operation"], row["nodes"], row["items"]))
+        if old is None or old["median_ms"] == 0:
+            continue
+        ratio = row["median_ms"] / old["median_ms"]
+        if ratio > 1 + threshold:
+            slower.append({**row, "baseline_median_ms": old["median_ms"], "ratio": ratio})
+            print(f"SLOWER: {row['operation']} with {row['nodes']} nodes, {row['items']} items: "
+                  f"{old['median_ms']:.4f} -> {row['median_ms']:.4f} ms ({ratio:.2f}x)")
+    if not slower:
+        print(f"No operation is more than {threshold:.0%} slower than {baseline_file}.")
+    return slower
+
+def plot_results(rows: list[dict], directory: str) -> list[str]:
+    """Saves a median-time vs node-count plot per operation (one line
+    per data size) as PNG files in directory. Returns their paths."""
+
+    # Non-interactive backend, never opens a window
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for operation in dict.fromkeys(row["operation"] for row in rows):
+        fig = plt.figure(operation)
+        for size in dict.fromkeys(row["items"] for row in rows):
+            series = [row for row in rows if row["operation"] == operation and row["items"] == size]
+            plt.plot([row["nodes"] for row in series], [row["median_ms"] for row in series],
+                     marker="o", label=f"{size} items")
         plt.xlabel("Node Count")
-        plt.ylabel("Time (ms)")
-        plt.title(process[0])
-        plt.show()
+        plt.ylabel("Median time (ms)")
+        plt.title(operation)
+        plt.legend()
+        path = os.path.join(directory, operation.replace(" ", "_").replace("'", "") + ".png")
+        fig.savefig(path)
+        plt.close(fig)
+        paths.append(path)
+    return paths
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks the Chord operations.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=10, help="untimed runs per operation")
+    parser.add_argument("--repeat", type=int, default=100, help="timed runs per operation")
+    parser.add_argument("--nodes", type=int, nargs="+", default=list(range(20, 301, 40)),
+                        help="node counts to sweep")
+    parser.add_argument("--items", type=int, nargs="+", default=[None],
+                        help="dataset sizes to sweep (default: the whole csv)")
+    parser.add_argument("--operations", nargs="+", default=OPERATIONS, choices=OPERATIONS, metavar="OPERATION")
+    parser.add_argument("--data", default="NH4_NO3.csv", help="csv dataset")
+    parser.add_argument("--knn", type=int, nargs="+", metavar="K",
+                        help="also time node and item kNN queries for these k")
+    parser.add_argument("--fail-fractions", type=float, nargs="+", metavar="FRACTION",
+                        help="also crash these fractions of the nodes: time to heal, lookup success rate, extra hops")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--csv", help="write the results to this csv file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="flag medians this fraction slower than the baseline")
+    parser.add_argument("--plot", metavar="DIR", help="save PNG plots in DIR")
+    args = parser.parse_args(argv)
+    if args.fail_fractions and not all(0 < fraction < 1 for fraction in args.fail_fractions):
+        parser.error("--fail-fractions must be in (0, 1)")
+    if min(args.nodes) < 2:
+        parser.error("--nodes must be at least 2, leaves and exact matches need other nodes")
+    return args
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(argv)
+    rows = benchmark_all(args.nodes, args.items, args.repeat, args.warmup, args.seed, args.data, args.operations)
+    if args.knn:
+        for size in args.items:
+            items = load_items(args.data, size)
+            for NC in args.nodes:
+                random.seed(args.seed)
+                rows.extend(benchmark_knn(NC, items, args.knn, args.repeat, args.warmup))
+    if args.fail_fractions:
+        for size in args.items:
+            items = load_items(args.data, size)
+            for NC in args.nodes:
+                random.seed(args.seed)
+                rows.extend(benchmark_failures(NC, items, args.fail_fractions, args.repeat, args.warmup))
+    results_print(rows)
 
-    return plots
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("json", "csv", "baseline", "plot")}
+    if args.json:
+        save_json(rows, config, args.json)
+    if args.csv:
+        save_csv(rows, args.csv)
+    if args.plot:
+        plot_results(rows, args.plot)
+    if args.baseline and compare(rows, args.baseline, args.threshold):
+        return 1
+    return 0
 
-results = benchmark_all()
-plot_results(results)
-#results_print(benchmark_all())
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
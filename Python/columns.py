@@ -0,0 +1,308 @@
+from array import array
+from config import RingConfig
+from store import ItemStore
+import numpy as np
+
+# Field kinds: array typecode and numpy dtype of the column
+KINDS = {
+    "category": ("I", np.uint32),
+    "int": ("q", np.int64),
+    "float": ("d", np.float64),
+}
+
+class RecordSchema:
+    """Fields of the records stored column-wise, for RingConfig.schema.
+    Category fields are interned ring-wide, so their codes stay valid
+    when items move between nodes."""
+
+    def __init__(self, fields: list[tuple[str, str]] = None) -> None:
+        if fields is None:
+            # The csv records (interface.COLUMNS)
+            fields = [("Date", "category"), ("Block", "int"), ("Plot", "int"),
+                      ("Experimental_treatment", "category"), ("Soil_NH4", "float"), ("Soil_NO3", "float")]
+        for name, kind in fields:
+            if kind not in KINDS:
+                raise ValueError(f"Field kind must be one of {tuple(KINDS)}, got {kind} for {name}.")
+        self.fields = list(fields)
+        self.kinds = dict(fields)
+        self.names = frozenset(self.kinds)
+        # Category field -> {label: code} and -> labels by code
+        self.codes = {name: {} for name, kind in fields if kind == "category"}
+        self.labels = {name: [] for name in self.codes}
+
+    def __repr__(self) -> str:
+        return f"RecordSchema({self.fields})"
+
+    def fits(self, value) -> bool:
+        """True if value is a record with exactly the schema's fields.
+        Their values may still not convert, write() then keeps it whole."""
+
+        return isinstance(value, dict) and value.keys() == self.names
+
+    def intern(self, name: str, label) -> int:
+        codes = self.codes[name]
+        code = codes.get(label)
+        if code is None:
+            code = codes[label] = len(codes)
+            self.labels[name].append(label)
+        return code
+
+    def encode(self, name: str, value):
+        kind = self.kinds[name]
+        if kind == "category":
+            return self.intern(name, value)
+        return int(value) if kind == "int" else float(value)
+
+    def decode(self, name: str, value):
+        if self.kinds[name] == "category":
+            return self.labels[name][value]
+        return value
+
+class ColumnarItemStore(ItemStore):
+    """ItemStore whose records are kept in one array per schema field
+    instead of one dict per item. The entries map keys to row numbers,
+    values that don't fit the schema are kept as they are. Records are
+    rebuilt as dicts when read, so get/update/delete work unchanged."""
+
+    __slots__ = ("schema", "columns", "others", "free")
+
+    def __init__(self, ring: RingConfig) -> None:
+        super().__init__(ring)
+        self.schema = ring.schema
+        self.columns = {name: array(KINDS[kind][0]) for name, kind in self.schema.fields}
+        # Row -> value, for values that don't fit the schema
+        self.others = {}
+        # Rows of removed items, reused before the columns grow
+        self.free = []
+
+    def __getitem__(self, key: str):
+        return self.decode(self.entries[key][1])
+
+    def values(self) -> list:
+        entries = self.entries
+        return [self.decode(entries[key][1]) for key in self.keys_list]
+
+    def items(self) -> list[tuple]:
+        entries = self.entries
+        return [(key, self.decode(entries[key][1])) for key in self.keys_list]
+
+    def copy(self) -> 'ColumnarItemStore':
+        """Copy with its own columns, rows keep their numbers."""
+
+        out = ColumnarItemStore(self.ring)
+        out.positions = list(self.positions)
+        out.keys_list = list(self.keys_list)
+        out.entries = dict(self.entries)
+        out.columns = {name: column[:] for name, column in self.columns.items()}
+        out.others = dict(self.others)
+        out.free = list(self.free)
+        return out
+
+    def iter_range(self, lo: int, hi: int, reverse: bool = False):
+        for pos, key, row in super().iter_range(lo, hi, reverse):
+            yield pos, key, self.decode(row)
+
+    def rows(self) -> int:
+        """Rows allocated in the columns, free ones included."""
+
+        return len(self.columns[self.schema.fields[0][0]])
+
+    def allocate(self) -> int:
+        if self.free:
+            return self.free.pop()
+        for column in self.columns.values():
+            column.append(0)
+        return self.rows() - 1
+
+    def release(self, row: int) -> None:
+        self.others.pop(row, None)
+        self.free.append(row)
+
+    def write(self, row: int, value) -> None:
+        schema = self.schema
+        if schema.fits(value):
+            # Every field is encoded before any column is written, so
+            # a record with a value that doesn't convert is kept whole
+            try:
+                encoded = [schema.encode(name, value[name]) for name in self.columns]
+            except (TypeError, ValueError, OverflowError):
+                encoded = None
+            if encoded is not None:
+                self.others.pop(row, None)
+                for column, code in zip(self.columns.values(), encoded):
+                    column[row] = code
+                return
+        self.others[row] = value
+
+    def decode(self, row: int):
+        if row in self.others:
+            return self.others[row]
+        decode = self.schema.decode
+        return {name: decode(name, column[row]) for name, column in self.columns.items()}
+
+    def copy_row(self, source: 'ColumnarItemStore', row: int) -> int:
+        """Copies a row of source into a new row of this store."""
+
+        new = self.allocate()
+        if row in source.others:
+            self.others[new] = source.others[row]
+        else:
+            for name, column in self.columns.items():
+                column[new] = source.columns[name][row]
+        return new
+
+    def put(self, key: str, value, pos: int = None) -> None:
+        if key in self.entries:
+            self.write(self.entries[key][1], value)
+            return
+        row = self.allocate()
+        self.write(row, value)
+        super().put(key, row, pos)
+
+    def remove(self, key: str):
+        row = super().remove(key)
+        value = self.decode(row)
+        self.release(row)
+        return value
+
+    def put_sorted(self, keys: list[str], values: list, positions: list[int]) -> None:
+        entries = self.entries
+        run = ItemStore(self.ring)
+        for key, value, pos in zip(keys, values, positions):
+            if key in entries:
+                self.write(entries[key][1], value)
+            elif key in run.entries:
+                self.write(run.entries[key][1], value)
+            else:
+                row = self.allocate()
+                self.write(row, value)
+                run.positions.append(pos)
+                run.keys_list.append(key)
+                run.entries[key] = (pos, row)
+        # The rows are already written, only the order is merged
+        ItemStore.merge(self, run)
+
+    def split(self, lo: int, hi: int) -> 'ColumnarItemStore':
+        moved = super().split(lo, hi)
+        out = ColumnarItemStore(self.ring)
+        out.positions, out.keys_list = moved.positions, moved.keys_list
+        entries = out.entries
+        for key, (pos, row) in moved.entries.items():
+            entries[key] = (pos, out.copy_row(self, row))
+            self.release(row)
+        self.compact()
+        return out
+
+    def merge(self, other: ItemStore) -> None:
+        """Moves all items of other, columnar or not, into this store."""
+
+        if not other.positions:
+            return
+        run = ItemStore(self.ring)
+        run.positions, run.keys_list = other.positions, other.keys_list
+        if isinstance(other, ColumnarItemStore):
+            run.entries = {key: (pos, self.copy_row(other, row)) for key, (pos, row) in other.entries.items()}
+            other.columns = {name: array(column.typecode) for name, column in other.columns.items()}
+            other.others, other.free = {}, []
+        else:
+            for key, (pos, value) in other.entries.items():
+                row = self.allocate()
+                self.write(row, value)
+                run.entries[key] = (pos, row)
+        other.positions, other.keys_list, other.entries = [], [], {}
+        ItemStore.merge(self, run)
+
+    def compact(self) -> None:
+        """Drops the free rows once they are most of the columns,
+        renumbering the rows in ring order."""
+
+        if len(self.free) <= max(64, self.rows() // 2):
+            return
+        entries = self.entries
+        old = [entries[key][1] for key in self.keys_list]
+        self.columns = {name: array(column.typecode, [column[row] for row in old])
+                        for name, column in self.columns.items()}
+        self.others = {new: self.others[row] for new, row in enumerate(old) if row in self.others}
+        self.free = []
+        for new, key in enumerate(self.keys_list):
+            entries[key] = (entries[key][0], new)
+
+    def partial(self, field: str, group_by: str = None) -> dict:
+        """aggregate_partial over the columns, vectorized with numpy."""
+
+        kinds = self.schema.kinds
+        if kinds.get(field) not in ("int", "float"):
+            raise ValueError(f"Can only aggregate the numeric fields, got {field}.")
+        if group_by is not None and group_by not in kinds:
+            raise ValueError(f"Unknown group_by field {group_by}.")
+        others = self.others
+        rows = np.fromiter((row for _, row in self.entries.values() if row not in others), dtype=np.int64)
+        partials = {}
+        if len(rows):
+            values = np.frombuffer(self.columns[field], dtype=KINDS[kinds[field]][1])[rows].astype(np.float64)
+            if group_by is None:
+                partials[None] = [len(values), float(values.sum()), float(values.min()), float(values.max())]
+            else:
+                codes = np.frombuffer(self.columns[group_by], dtype=KINDS[kinds[group_by]][1])[rows]
+                groups, inverse = np.unique(codes, return_inverse=True)
+                counts = np.bincount(inverse)
+                sums = np.bincount(inverse, weights=values)
+                mins = np.full(len(groups), np.inf)
+                maxs = np.full(len(groups), -np.inf)
+                np.minimum.at(mins, inverse, values)
+                np.maximum.at(maxs, inverse, values)
+                decode = self.schema.decode
+                for i, code in enumerate(groups.tolist()):
+                    partials[decode(group_by, code)] = [int(counts[i]), float(sums[i]), float(mins[i]), float(maxs[i])]
+        # Values outside the schema, e.g. records with extra fields
+        if others:
+            merge_partials(partials, aggregate_partial(others.values(), field, group_by))
+        return partials
+
+def make_store(ring: RingConfig) -> ItemStore:
+    """Item store of a node, columnar when the ring has a schema."""
+
+    if ring.schema is not None:
+        return ColumnarItemStore(ring)
+    return ItemStore(ring)
+
+def aggregate_partial(values, field: str, group_by: str = None) -> dict:
+    """Map step of Interface.aggregate: {group: [count, sum, min, max]}
+    of field over the record values. Records without the field, or
+    whose value isn't a number, are skipped. The group is None without
+    group_by."""
+
+    partials = {}
+    for record in values:
+        if not isinstance(record, dict) or field not in record:
+            continue
+        try:
+            value = float(record[field])
+        except (TypeError, ValueError):
+            continue
+        group = record.get(group_by) if group_by is not None else None
+        partial = partials.get(group)
+        if partial is None:
+            partials[group] = [1, value, value, value]
+        else:
+            partial[0] += 1
+            partial[1] += value
+            if value < partial[2]:
+                partial[2] = value
+            if value > partial[3]:
+                partial[3] = value
+    return partials
+
+def merge_partials(total: dict, partials: dict) -> dict:
+    """Reduce step of Interface.aggregate, merges partials into total."""
+
+    for group, (count, value_sum, value_min, value_max) in partials.items():
+        merged = total.get(group)
+        if merged is None:
+            total[group] = [count, value_sum, value_min, value_max]
+        else:
+            merged[0] += count
+            merged[1] += value_sum
+            merged[2] = min(merged[2], value_min)
+            merged[3] = max(merged[3], value_max)
+    return total
@@ -0,0 +1,387 @@
+from interface import Interface
+from config import RingConfig
+from node import Node
+from stats import percentile, timed
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread, get_ident, local
+from time import perf_counter
+import random
+
+class RWLock:
+    """Many readers or one writer. Waiting writers go first, so churn
+    isn't starved by a read-heavy load. The writer may re-enter, and
+    read, which lets membership operations call each other. Readers may
+    re-enter too, e.g. knn_items walking the ring under a read lock."""
+
+    def __init__(self) -> None:
+        self.cond = Condition(Lock())
+        self.readers = 0
+        # Nested read depth of every thread
+        self.local = local()
+        self.writer = None
+        self.depth = 0
+        self.waiting_writers = 0
+
+    @contextmanager
+    def reading(self):
+        local = self.local
+        depth = getattr(local, "depth", 0)
+        # Nested reads and the writer's reads already hold the lock,
+        # and mustn't wait for writers queued behind them
+        owned = depth or self.writer == get_ident()
+        if not owned:
+            with self.cond:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+                self.readers += 1
+        local.depth = depth + 1
+        try:
+            yield
+        finally:
+            local.depth = depth
+            if not owned:
+                with self.cond:
+                    self.readers -= 1
+                    if not self.readers:
+                        self.cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = get_ident()
+        with self.cond:
+            if self.writer != me:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+            self.depth += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.depth -= 1
+                if not self.depth:
+                    self.writer = None
+                    self.cond.notify_all()
+
+class ThreadSafeInterface(Interface):
+    """Interface that many client threads can share.
+
+    Membership changes (join, leave, failures, stabilization) and batch
+    operations hold the membership lock exclusively, so they never run
+    while a point operation is routing or a key is migrating between
+    nodes. Point operations hold it shared, plus the striped locks of
+    the nodes they touch (the primary and its replica holders), taken
+    in stripe order. Writes to indexed rings are serialized, since one
+    write updates the posting lists of several nodes.
+
+    Routing and pointer walks (knn, range queries, batched lookups)
+    hold it shared too. Range walks and aggregates hold it shared and
+    lock one node at a time: every node's items are read consistently,
+    but a scan isn't a snapshot of the whole ring. The range generators
+    take the locks for every step, not while the caller holds an item."""
+
+    def __init__(self, ring: RingConfig = None, cache_size: int = 0, read_policy: str = "primary",
+                 stripes: int = 64) -> None:
+        super().__init__(ring, cache_size, read_policy)
+        self.membership = RWLock()
+        self.stripes = [Lock() for _ in range(stripes)]
+        # The location cache is one OrderedDict, cached lookups take turns
+        self.cache_lock = Lock()
+        self.index_lock = Lock()
+
+    @contextmanager
+    def locked(self, nodes: list[Node]):
+        """Holds the stripe locks of nodes, acquired in stripe order."""
+
+        stripes = sorted({hash(node.id) % len(self.stripes) for node in nodes})
+        for stripe in stripes:
+            self.stripes[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.stripes[stripe].release()
+
+    @contextmanager
+    def writing(self):
+        """Shared membership lock of a point write, and the
+        index lock when there are posting lists to update."""
+
+        with self.membership.reading():
+            if self.indexes:
+                with self.index_lock:
+                    yield
+            else:
+                yield
+
+    def lookup(self, pos: int, start_node_id: int = None) -> Node:
+        if not self.cache_size:
+            return super().lookup(pos, start_node_id)
+        with self.cache_lock:
+            return super().lookup(pos, start_node_id)
+
+    @timed("get_item")
+    def get_item(self, key: str, start_node_id: int = None):
+        with self.membership.reading():
+            node = self.read_replica(self.lookup(self.ring.hash_func(key), start_node_id))
+            with self.locked([node]):
+                return node.read(key)
+
+    def get_items(self, keys: list[str], start_node_id: int = None) -> list:
+        keys = list(keys)
+        with self.membership.reading():
+            positions = [self.ring.hash_func(key) for key in keys]
+            owners = self.find_successor_many(positions, start_node_id)
+            values = []
+            for key, pos in zip(keys, positions):
+                with self.locked([owners[pos]]):
+                    values.append(owners[pos].read(key))
+            return values
+
+    @timed("insert_item")
+    def insert_item(self, new_item: tuple, start_node_id: int = None) -> None:
+        with self.writing():
+            pos = self.ring.hash_func(new_item[0])
+            node = self.lookup(pos, start_node_id)
+            with self.locked([node] + node.replica_holders()):
+                old = node.items[new_item[0]] if self.indexes and new_item[0] in node.items else None
+                node.insert_item_to_node(new_item, pos=pos)
+            if self.indexes:
+                self.apply_index_changes(self.index_changes({}, new_item[0], old, new_item[1]), start_node_id)
+
+    @timed("update_record")
+    def update_record(self, new_item: tuple, start_node_id: int = None, print_item: bool = False) -> None:
+        with self.writing():
+            pos = self.ring.hash_func(new_item[0])
+            node = self.lookup(pos, start_node_id)
+            with self.locked([node] + node.replica_holders()):
+                found = new_item[0] in node.items
+                if found:
+                    old = node.items[new_item[0]] if self.indexes else None
+                    node.insert_item_to_node(new_item, print_item=print_item, pos=pos)
+            if not found:
+                print(f"Could not find item with key {new_item[0]}")
+            elif self.indexes:
+                self.apply_index_changes(self.index_changes({}, new_item[0], old, new_item[1]), start_node_id)
+
+    @timed("delete_item")
+    def delete_item(self, key: str, start_node_id: int = None, item_print=False):
+        with self.writing():
+            node = self.lookup(self.ring.hash_func(key), start_node_id)
+            with self.locked([node] + node.replica_holders()):
+                old = node.items[key] if self.indexes and key in node.items else None
+                node.delete_item_from_node(key, item_print=item_print)
+            if old is not None:
+                self.apply_index_changes(self.index_changes({}, key, old, None), start_node_id)
+
+    def update_posting(self, node: Node, index_key: str, pos: int, added: dict, removed: set) -> None:
+        with self.locked([node] + node.replica_holders()):
+            super().update_posting(node, index_key, pos, added, removed)
+
+    def posting_list(self, index_key: str, start_node_id: int = None) -> dict:
+        """Copy of the posting list, writers update it in place."""
+
+        with self.membership.reading():
+            node = self.lookup(self.ring.sha1_hash(index_key), start_node_id)
+            with self.locked([node]):
+                return dict(node.items[index_key]) if index_key in node.items else {}
+
+    def locked_steps(self, items):
+        """Advances the generator items under the shared membership lock,
+        so its routing and pointer walks never see a join half done."""
+
+        while True:
+            with self.membership.reading():
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+
+    def iter_range_query(self, start: int, end: int, start_node_id: int = None):
+        return self.locked_steps(super().iter_range_query(start, end, start_node_id))
+
+    def walk_items(self, start: int, end: int, start_node_id: int = None):
+        return self.locked_steps(super().walk_items(start, end, start_node_id))
+
+    def walk_items_back(self, start: int, end: int, start_node_id: int = None):
+        return self.locked_steps(super().walk_items_back(start, end, start_node_id))
+
+    def find_successor_many(self, keys: list[int], start_node_id: int = None) -> dict:
+        with self.membership.reading():
+            return super().find_successor_many(keys, start_node_id)
+
+    def knn(self, k: int, node_id: int, start_node_id: int = None) -> list[Node]:
+        with self.membership.reading():
+            return super().knn(k, node_id, start_node_id)
+
+    def knn_items(self, k: int, key, start_node_id: int = None) -> list[tuple]:
+        with self.membership.reading():
+            return super().knn_items(k, key, start_node_id)
+
+    def exact_match(self, key: int, start_node_id: int = None) -> Node | None:
+        with self.membership.reading():
+            return super().exact_match(key, start_node_id)
+
+    def check_successor(self, key: int, start_node_id: int = None) -> bool:
+        with self.membership.reading():
+            return super().check_successor(key, start_node_id)
+
+    def node_range(self, node: Node, lo: int, hi: int, reverse: bool = False):
+        with self.locked([node]):
+            return list(super().node_range(node, lo, hi, reverse))
+
+    def aggregate(self, field: str, group_by: str = None) -> dict:
+        """Interface.aggregate, locking one node at a time like range walks."""
+
+        with self.membership.reading():
+            return super().aggregate(field, group_by)
+
+    def node_partial(self, node: Node, field: str, group_by: str = None) -> dict:
+        with self.locked([node]):
+            return super().node_partial(node, field, group_by)
+
+    # Membership changes and batch operations run alone
+
+    def build_network(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().build_network(*args, **kwargs)
+
+    def node_join(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().node_join(*args, **kwargs)
+
+    def node_leave(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().node_leave(*args, **kwargs)
+
+    def fail_nodes(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().fail_nodes(*args, **kwargs)
+
+    def stabilize_round(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().stabilize_round(*args, **kwargs)
+
+    def heal(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().heal(*args, **kwargs)
+
+    def balanced_join(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().balanced_join(*args, **kwargs)
+
+    def physical_leave(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().physical_leave(*args, **kwargs)
+
+    def insert_items(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().insert_items(*args, **kwargs)
+
+    def update_records(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().update_records(*args, **kwargs)
+
+    def delete_items(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().delete_items(*args, **kwargs)
+
+    def bulk_load(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().bulk_load(*args, **kwargs)
+
+    def create_index(self, *args, **kwargs):
+        with self.membership.writing():
+            return super().create_index(*args, **kwargs)
+
+def run_clients(interface: Interface, operations: list[tuple], threads: int) -> dict:
+    """Runs (op, argument) operations from a ThreadPoolExecutor of
+    threads clients, every client taking an interleaved share. op is
+    "read", "insert", "update" or "delete". Returns the throughput,
+    the latency percentiles of every op and the reads that missed."""
+
+    calls = {
+        "read": interface.get_item,
+        "insert": interface.insert_item,
+        "update": interface.update_record,
+        "delete": interface.delete_item,
+    }
+
+    def client(share: list[tuple]) -> tuple[dict, int]:
+        latencies = {}
+        missed = 0
+        for op, argument in share:
+            start = perf_counter()
+            result = calls[op](argument)
+            latencies.setdefault(op, []).append(perf_counter() - start)
+            if op == "read" and result is None:
+                missed += 1
+        return latencies, missed
+
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(client, [operations[i::threads] for i in range(threads)]))
+    seconds = perf_counter() - start
+
+    latencies = {}
+    for share, _ in results:
+        for op, values in share.items():
+            latencies.setdefault(op, []).extend(values)
+    report = {}
+    for op, values in latencies.items():
+        values.sort()
+        report[op] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    return {
+        "threads": threads,
+        "ops": len(operations),
+        "seconds": seconds,
+        "ops_per_sec": len(operations) / seconds,
+        "missed_reads": sum(missed for _, missed in results),
+        "latency": report,
+    }
+
+def benchmark(node_count: int = 1000, item_count: int = 20_000, operation_count: int = 20_000,
+              thread_counts: list[int] = [1, 2, 4, 8], churn: int = 50, ks: int = 32) -> list[dict]:
+    """Throughput and latency of read-heavy (95% reads) and mixed (50%)
+    workloads of updates and reads as the client threads grow. With
+    churn, a thread joins and removes that many nodes during every run;
+    no read of an existing key may miss while items migrate."""
+
+    keys = [f"key {i}" for i in range(item_count)]
+    results = []
+    for workload, read_fraction in (("read-heavy", 0.95), ("mixed", 0.5)):
+        for threads in thread_counts:
+            interface = ThreadSafeInterface(RingConfig(ks=ks))
+            interface.build_network(node_count, bulk=True)
+            interface.bulk_load(keys, list(range(item_count)))
+            operations = [("read", key) if random.random() < read_fraction else ("update", (key, -1))
+                          for key in random.choices(keys, k=operation_count)]
+
+            def churner() -> None:
+                for _ in range(churn):
+                    node_id = random.randrange(interface.ring.hs)
+                    if node_id not in interface.nodes:
+                        interface.node_join(node_id)
+                        interface.node_leave(node_id)
+
+            background = Thread(target=churner)
+            background.start()
+            result = run_clients(interface, operations, threads)
+            background.join()
+            result["workload"] = workload
+            results.append(result)
+            print(f"{workload:10} threads={threads}: {result['ops_per_sec']:.0f} ops/s, "
+                  f"read p99 {result['latency'].get('read', {}).get('p99_ms', 0):.3f} ms, "
+                  f"missed reads {result['missed_reads']}")
+    return results
+
+if __name__ == "__main__":
+    benchmark()
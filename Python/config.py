@@ -0,0 +1,106 @@
+from datetime import datetime
+import hashlib
+import random
+
+def date_plot_encoder(ks: int):
+    """Order-preserving encoding of 'M/D/YYYY_Plot' keys, for
+    RingConfig.key_encoder. The date's ordinal and the plot number are
+    packed into 38 bits (date first) and scaled to the ring's ks bits,
+    so keys keep their chronological order on the ring. Items cluster
+    on the arc their dates span instead of spreading uniformly."""
+
+    shift = ks - 38
+
+    def encode(key: str) -> int:
+        date, plot = key.split("_", 1)
+        code = datetime.strptime(date, "%m/%d/%Y").toordinal() << 16 | int(plot)
+        return code << shift if shift >= 0 else code >> -shift
+    return encode
+
+class RingConfig:
+    """Parameters of a Chord ring: key size (bits), hashing space,
+    successor list size, replication, how keys are placed on the ring
+    and how records are stored.
+
+    It also holds the runtime state the ring's nodes share (stats, the
+    notify epoch and the schema's interned codes), so a RingConfig
+    belongs to one Interface, which rejects a config already in use."""
+
+    def __init__(self, ks: int = 160, sls: int = 3, key_encoder=None, replicas: int = 0, schema=None) -> None:
+        if not 1 <= ks <= 160:
+            raise ValueError(f"Key size must be in [1, 160] bits, got {ks}.")
+        if not 0 <= replicas <= sls:
+            raise ValueError(f"Replicas must be in [0, {sls}] (the successor list size), got {replicas}.")
+        # Key size (bits)
+        self.ks = ks
+        # Hashing space
+        self.hs = 1 << ks
+        # Mask used instead of modulo, hs is a power of 2
+        self.mask = self.hs - 1
+        # Successor list size
+        self.sls = sls
+        # Copies of every item kept on the first successors, 0 disables replication
+        self.replicas = replicas
+        # Optional order-preserving key -> position function, used
+        # instead of SHA-1 (e.g. date_plot_encoder(ks))
+        self.key_encoder = key_encoder
+        # Optional columns.RecordSchema, nodes then store records column-wise
+        self.schema = schema
+        # Finger table offsets 2^i, i ∈ [0, ks)
+        self.offsets = tuple(1 << i for i in range(ks))
+        # stats.Stats shared by the ring's nodes, None disables instrumentation
+        self.stats = None
+        # Bumped by a node whenever its predecessor changes in notify, i.e.
+        # when items change owner outside of Interface's joins and leaves
+        self.epoch = 0
+        # Interface of the ring, set once by Interface.__init__
+        self.interface = None
+
+    def __getstate__(self) -> dict:
+        # Copies (e.g. sent to worker processes) don't carry the Interface
+        return dict(self.__dict__, interface=None)
+
+    def __repr__(self) -> str:
+        return f"RingConfig(ks={self.ks}, sls={self.sls}, replicas={self.replicas})"
+
+    def hash_func(self, data: str) -> int:
+        """SHA-1 of data, folded into the hashing space.
+        With a key_encoder, the encoded key instead."""
+
+        if self.key_encoder is not None:
+            return self.key_encoder(data) & self.mask
+        return self.sha1_hash(data)
+
+    def sha1_hash(self, data: str) -> int:
+        """SHA-1 of data folded into the hashing space, whatever the
+        key_encoder (for keys it can't encode, e.g. index keys)."""
+
+        digest = hashlib.sha1(data.encode("utf-8")).digest()
+        return int.from_bytes(digest, "big") & self.mask
+
+    def random_ids(self, count: int) -> set[int]:
+        """count distinct random positions of the hashing space."""
+
+        # random.sample can't index ranges wider than 2^63
+        ids = set()
+        while len(ids) < count:
+            ids.add(random.randrange(self.hs))
+        return ids
+
+    def cw_dist(self, k1: int, k2: int) -> int:
+        """Clockwise distance of 2 keys"""
+
+        return (k2 - k1) & self.mask
+
+    def comp_cw_dist(self, k1: int, k2: int, dest: int) -> bool:
+        """Returns true if clockwise distance of k1 from dest
+        is bigger than clockwise distance of k2 from dest.
+        In other words, k2 ∈ (k1, dest]"""
+
+        mask = self.mask
+        return ((dest - k1) & mask) > ((dest - k2) & mask)
+
+    def finger_pos(self, node_id: int, i: int) -> int:
+        """Position of the i-th finger table entry of node_id."""
+
+        return (node_id + self.offsets[i]) & self.mask
@@ -1,93 +1,400 @@
 from xmlrpc.client import boolean
-from node import Node, hash_func, cw_dist
+from node import Node, build_tables
+from config import RingConfig
+from stats import Stats, timed
+from columns import merge_partials
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime
+from time import perf_counter
 import random
+import numpy as np
 import pandas as pd
-from main import HS, KS
+
+# Record fields, in csv column order
+COLUMNS = ['Date', 'Block', 'Plot', 'Experimental_treatment', 'Soil_NH4', 'Soil_NO3']
+
+def frame_to_items(df: pd.DataFrame) -> tuple[list[str], list[dict]]:
+    """Returns the keys (Date_Plot) and records of a csv DataFrame,
+    built column-wise instead of row by row."""
+
+    df.columns = COLUMNS
+    keys = (df['Date'].astype(str) + '_' + df['Plot'].astype(str)).tolist()
+    return keys, df.to_dict('records')
 
 def parse_csv(filename: str) -> dict:
     """Parses csv and returns a list of items."""
 
-    items = {}
-    df = pd.read_csv(filename)
+    keys, records = frame_to_items(pd.read_csv(filename))
+    return dict(zip(keys, records))
 
-    for i in range(len(df)):
-        key = '_'.join([df.values[i][0], str(df.values[i][2])])
+def stream_csv(filename: str, chunk_size: int = 100_000):
+    """Yields (keys, records) batches of at most chunk_size csv rows,
+    so only one chunk is held in memory at a time.
+    If chunk_size is None the whole file is a single batch."""
 
-        data = {
-            'Date': df.values[i][0],
-            'Block': df.values[i][1],
-            'Plot': df.values[i][2],
-            'Experimental_treatment': df.values[i][3],
-            'Soil_NH4': df.values[i][4],
-            'Soil_NO3': df.values[i][5],
-        }
-        items[key] = data
-    
-    return items
+    if chunk_size is None:
+        yield frame_to_items(pd.read_csv(filename))
+        return
+    for df in pd.read_csv(filename, chunksize=chunk_size):
+        yield frame_to_items(df)
+
+# Where get_item reads replicated items from
+READ_POLICIES = ("primary", "random", "least-loaded")
+
+# Secondary index kinds: a posting list per value, or per month of M/D/YYYY dates
+INDEX_KINDS = ("value", "date")
+# Prefix of the posting list keys, never a Date_Plot key
+INDEX_PREFIX = "#index:"
+
+def is_index_key(key) -> bool:
+    return isinstance(key, str) and key.startswith(INDEX_PREFIX)
+
+def date_ordinal(date: str) -> int:
+    return datetime.strptime(date, "%m/%d/%Y").toordinal()
 
 class Interface:
-    def __init__(self) -> None:
+    def __init__(self, ring: RingConfig = None, cache_size: int = 0, read_policy: str = "primary") -> None:
+        if read_policy not in READ_POLICIES:
+            raise ValueError(f"Read policy must be one of {READ_POLICIES}, got {read_policy}.")
+        self.ring = ring if ring is not None else RingConfig()
+        if self.ring.interface is not None:
+            raise ValueError(f"{self.ring!r} is already used by another Interface, its stats, epoch and "
+                             f"schema codes are per ring. Create a RingConfig per Interface.")
+        self.ring.interface = self
+        self.read_policy = read_policy
         self.nodes = {}
+        # Ids of all nodes in the network, kept sorted on join/leave
+        self.sorted_ids = []
+        # Membership epoch, bumped on every node join/leave
+        self.epoch = 0
+        # LRU location cache: hashed key -> (node, (epoch, ring.epoch)). 0 disables it.
+        self.cache_size = cache_size
+        self.location_cache = OrderedDict()
+        self.cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        # Secondary indexes, field -> kind (INDEX_KINDS)
+        self.indexes = {}
         
-    def build_network(self, node_count: int, node_ids: list = []) -> None:
-        """Creates nodes and inserts them into the network."""
+    def build_network(self, node_count: int, node_ids: list = [], bulk: bool = False, vnodes: int = 1) -> None:
+        """Creates nodes and inserts them into the network.
+        With bulk, an empty network is built directly from the
+        sorted ids instead of joining nodes one by one.
+        With vnodes > 1, every id is a physical node that also gets
+        vnodes - 1 more (virtual) random ring positions."""
 
         if node_ids == []:
-            final_ids = random.sample(range(HS), node_count)
+            final_ids = self.ring.random_ids(node_count)
         else: 
             final_ids = node_ids
 
-        for x in final_ids:
-            self.node_join(new_node_id=x)
+        # Ring position -> physical node id
+        owners = {node_id: node_id for node_id in final_ids}
+        if vnodes > 1:
+            if len(owners) * vnodes > self.ring.hs - len(self.nodes):
+                raise ValueError(f"Not enough free ids for {vnodes} virtual nodes per node.")
+            for physical in list(owners):
+                for _ in range(vnodes - 1):
+                    node_id = random.randrange(self.ring.hs)
+                    while node_id in owners or node_id in self.nodes:
+                        node_id = random.randrange(self.ring.hs)
+                    owners[node_id] = physical
+
+        if bulk and not self.nodes:
+            self.bulk_build(list(owners))
+            for node_id, physical in owners.items():
+                if node_id in self.nodes:
+                    self.nodes[node_id].owner = physical
+            return
+
+        for x, physical in owners.items():
+            self.node_join(new_node_id=x, owner=physical)
+
+    def bulk_build(self, node_ids: list[int]) -> None:
+        """Builds the network in O(N log N) by computing every predecessor,
+        finger table and successor list from the sorted ids. The result is
+        identical to joining the nodes one by one."""
+
+        ring = self.ring
+        ordered_ids = []
+        for node_id in node_ids:
+            if not 0 <= node_id < ring.hs:
+                print(f"{hex(node_id)} not in hashing space, can't create node.")
+            elif node_id not in self.nodes:
+                self.nodes[node_id] = Node(node_id, ring)
+                ordered_ids.append(node_id)
+        if not ordered_ids:
+            return
+
+        ids = sorted(ordered_ids)
+        nodes = [self.nodes[node_id] for node_id in ids]
+        # Table indices wrap around the ring at most once
+        build_tables(ring, ids, range(len(ids)), (nodes + nodes).__getitem__)
+        self.sorted_ids = ids
+        self.epoch += 1
             
-    def node_join(self, new_node_id: int, start_node_id: int = None, print_node: boolean = False) -> None:
-        """Adds node to the network."""
+    @timed("node_join")
+    def node_join(self, new_node_id: int, start_node_id: int = None, print_node: boolean = False,
+                  lazy: bool = False, owner: int = None) -> None:
+        """Adds node to the network. With lazy, the node only learns its
+        successor and periodic stabilization integrates it, as in Chord.
+        owner is the physical node of a virtual node, itself by default."""
         
-        if new_node_id not in range(HS):
+        if not 0 <= new_node_id < self.ring.hs:
             print(f"{hex(new_node_id)} not in hashing space, can't create node.")
             return
+        if new_node_id in self.nodes:
+            print(f"Node {hex(new_node_id)} already in the network.")
+            return
         if print_node:
             print(f"Creating and adding node {hex(new_node_id)} to the network...")
-        new_node = Node(new_node_id)
+        new_node = Node(new_node_id, self.ring)
+        if owner is not None:
+            new_node.owner = owner
         # First node.
         if not self.nodes:
             new_node.pred = new_node
             # Initialize finger table.
-            new_node.f_table = [ [(new_node.id + 2**i) % HS, new_node] for i in range(KS) ]
+            new_node.fingers = [new_node] * self.ring.ks
+        elif lazy:
+            new_node.join(self.get_node(start_node_id))
         else:
-            start_node = self.get_node(start_node_id)
             # Find new node successor and insert the new node before it.
-            start_node.find_successor(new_node.id).insert_new_pred(new_node)
+            self.find_successor(new_node.id, start_node_id).insert_new_pred(new_node)
 
         self.nodes[new_node.id] = new_node
+        insort(self.sorted_ids, new_node.id)
+        self.epoch += 1
 
+    @timed("insert_item")
     def insert_item(self, new_item: tuple, start_node_id: int = None) -> None:
         """Inserts an item (key, value) to the correct node of the network."""
 
-        start_node = self.get_node(start_node_id)
-        succ = start_node.find_successor(hash_func(new_item[0]))
-        succ.insert_item_to_node(new_item)
-        #print(f"Inserting item with hashed key: {hash_func(new_item[0]} to node with ID: {succ.id}")
+        pos = self.ring.hash_func(new_item[0])
+        succ = self.lookup(pos, start_node_id)
+        old = succ.items[new_item[0]] if self.indexes and new_item[0] in succ.items else None
+        succ.insert_item_to_node(new_item, pos=pos)
+        if self.indexes:
+            self.apply_index_changes(self.index_changes({}, new_item[0], old, new_item[1]), start_node_id)
+        #print(f"Inserting item with hashed key: {self.ring.hash_func(new_item[0]} to node with ID: {succ.id}")
 
+    @timed("delete_item")
     def delete_item(self, key: str, start_node_id: int = None, item_print=False):
         """Finds node responsible for key and removes the (key, value) entry from it."""
 
-        start_node = self.get_node(start_node_id)
-        start_node.find_successor(hash_func(key)).delete_item_from_node(key,item_print=item_print)
+        node = self.lookup(self.ring.hash_func(key), start_node_id)
+        old = node.items[key] if self.indexes and key in node.items else None
+        node.delete_item_from_node(key,item_print=item_print)
+        if old is not None:
+            self.apply_index_changes(self.index_changes({}, key, old, None), start_node_id)
+
+    @timed("get_item")
+    def get_item(self, key: str, start_node_id: int = None):
+        """Returns the record (value) of an item given its key, or None.
+        With replication, the read goes to the primary or one of its
+        replicas, as chosen by the read policy."""
+
+        return self.read_replica(self.lookup(self.ring.hash_func(key), start_node_id)).read(key)
+
+    def read_replica(self, node: Node) -> Node:
+        """The node a read of one of node's items goes to: node itself,
+        or with replication the replica the read policy picks."""
+
+        if self.ring.replicas and self.read_policy != "primary":
+            replicas = [node] + node.replica_holders()
+            if self.read_policy == "random":
+                return random.choice(replicas)
+            return min(replicas, key=lambda replica: replica.reads)
+        return node
+
+    def lookup(self, pos: int, start_node_id: int = None) -> Node:
+        """Returns the node responsible for a hashed key. Answers from the
+        location cache when enabled and the entry is from the current
+        membership epoch, otherwise routes with find_successor. Lazy joins
+        and failures move items later, in notify, which bumps ring.epoch."""
+
+        epoch = (self.epoch, self.ring.epoch)
+        if self.cache_size:
+            entry = self.location_cache.get(pos)
+            if entry is not None and entry[1] == epoch:
+                self.location_cache.move_to_end(pos)
+                self.cache_stats["hits"] += 1
+                return entry[0]
+            # Stale entries count both as invalidations and misses
+            if entry is not None:
+                self.cache_stats["invalidations"] += 1
+            self.cache_stats["misses"] += 1
+
+        node = self.find_successor(pos, start_node_id)
+
+        if self.cache_size:
+            self.location_cache[pos] = (node, epoch)
+            self.location_cache.move_to_end(pos)
+            if len(self.location_cache) > self.cache_size:
+                self.location_cache.popitem(last=False)
+        return node
         
+    def find_successor(self, key: int, start_node_id: int = None) -> Node:
+        """Routes key from the start node to the node responsible for it.
+        A node whose successors and fingers all failed can't route until
+        stabilization rejoins it, the membership registry (sorted_ids)
+        answers instead, as in stabilize_round."""
+
+        node = self.get_node(start_node_id).find_successor(key)
+        if node is None:
+            node = self.nodes[self.successor_id(key)]
+        return node
+
+    def alive_successor(self, node: Node) -> Node:
+        """node's first alive successor. When every successor and finger
+        failed, routing can't reach the rest of the ring, the node is
+        rejoined through the membership registry, as a bootstrap server would."""
+
+        succ = node.get_first_alive_succ()
+        if succ is None:
+            succ = self.nodes[self.successor_id((node.id + 1) & self.ring.mask)]
+        return succ
+
+    def find_successor_many(self, keys: list[int], start_node_id: int = None) -> dict:
+        """Returns a {key: responsible node} mapping, routing all keys
+        together. Unroutable keys fall back to the registry, as in find_successor."""
+
+        owners = self.get_node(start_node_id).find_successor_many(keys)
+        for key, node in owners.items():
+            if node is None:
+                owners[key] = self.nodes[self.successor_id(key)]
+        return owners
+
+    @timed("insert_items")
+    def insert_items(self, new_items: list[tuple], start_node_id: int = None) -> None:
+        """Inserts many items (key, value) with one batched lookup."""
+
+        new_items = list(new_items)
+        positions = [self.ring.hash_func(item[0]) for item in new_items]
+        owners = self.find_successor_many(positions, start_node_id)
+        changes = {}
+        for item, pos in zip(new_items, positions):
+            items = owners[pos].items
+            if self.indexes:
+                self.index_changes(changes, item[0], items[item[0]] if item[0] in items else None, item[1])
+            owners[pos].insert_item_to_node(item, pos=pos)
+        self.apply_index_changes(changes, start_node_id)
+
+    @timed("update_records")
+    def update_records(self, new_items: list[tuple], start_node_id: int = None) -> None:
+        """Updates the records of many existing items with one batched lookup."""
+
+        new_items = list(new_items)
+        positions = [self.ring.hash_func(item[0]) for item in new_items]
+        owners = self.find_successor_many(positions, start_node_id)
+        changes = {}
+        for item, pos in zip(new_items, positions):
+            items = owners[pos].items
+            if item[0] in items:
+                if self.indexes:
+                    self.index_changes(changes, item[0], items[item[0]], item[1])
+                owners[pos].insert_item_to_node(item, pos=pos)
+            else:
+                print(f"Could not find item with key {item[0]}")
+        self.apply_index_changes(changes, start_node_id)
+
+    @timed("delete_items")
+    def delete_items(self, keys: list[str], start_node_id: int = None) -> None:
+        """Removes many items with one batched lookup."""
+
+        keys = list(keys)
+        positions = [self.ring.hash_func(key) for key in keys]
+        owners = self.find_successor_many(positions, start_node_id)
+        changes = {}
+        for key, pos in zip(keys, positions):
+            items = owners[pos].items
+            if self.indexes and key in items:
+                self.index_changes(changes, key, items[key], None)
+            owners[pos].delete_item_from_node(key)
+        self.apply_index_changes(changes, start_node_id)
+
     def insert_all_data(self, dict_items: list[tuple], start_node_id: int = None) -> None:
         """Inserts all data from parsed csv into the correct nodes."""
 
-        for dict_item in dict_items:
-            self.insert_item(dict_item, start_node_id)
+        dict_items = list(dict_items)
+        self.bulk_load([item[0] for item in dict_items], [item[1] for item in dict_items])
+
+    @timed("bulk_load")
+    def bulk_load(self, keys: list[str], values: list) -> None:
+        """Inserts many items at once. Keys are hashed in one pass,
+        sorted by ring position and assigned to their responsible
+        nodes with a single searchsorted over the sorted node ids."""
+
+        if not keys or not self.sorted_ids:
+            return
+
+        # uint64 can't hold positions of rings wider than 64 bits
+        dtype = np.uint64 if self.ring.ks <= 64 else object
+        hash_func = self.ring.hash_func
+        positions = np.array([hash_func(key) for key in keys], dtype=dtype)
+        order = np.argsort(positions, kind='stable')
+        owners = np.searchsorted(np.array(self.sorted_ids, dtype=dtype), positions[order])
+        # Positions after the last node belong to the first one
+        owners[owners == len(self.sorted_ids)] = 0
+
+        positions = positions[order].tolist()
+        order = order.tolist()
+        bounds = [0] + (np.flatnonzero(np.diff(owners)) + 1).tolist() + [len(order)]
+        changes = {}
+        for start, end in zip(bounds, bounds[1:]):
+            node = self.nodes[self.sorted_ids[owners[start]]]
+            run = order[start:end]
+            run_keys, run_values = [keys[i] for i in run], [values[i] for i in run]
+            if self.indexes:
+                # A key repeated in the run replaces its earlier value
+                latest = {}
+                for key, value in zip(run_keys, run_values):
+                    old = latest[key] if key in latest else node.items[key] if key in node.items else None
+                    self.index_changes(changes, key, old, value)
+                    latest[key] = value
+            node.items.put_sorted(run_keys, run_values, positions[start:end])
+            if self.ring.replicas:
+                for succ in node.replica_holders():
+                    succ.replicas.put_sorted(run_keys, run_values, positions[start:end])
+        self.apply_index_changes(changes)
+
+    def load_csv(self, filename: str, chunk_size: int = None) -> dict:
+        """Parses csv and bulk loads its items into the network.
+        If chunk_size is given the file is streamed in chunks.
+        Returns the ingestion counters."""
+
+        progress = {}
+        for progress in self.ingest_csv(filename, chunk_size):
+            pass
+        return progress
+
+    def ingest_csv(self, filename: str, chunk_size: int = 100_000, print_progress: bool = False):
+        """Streams csv into the network chunk by chunk.
+        Yields the progress counters after every chunk."""
+
+        progress = {"rows": 0, "chunks": 0, "seconds": 0.0, "rows_per_sec": 0.0}
+        start = perf_counter()
+        for keys, records in stream_csv(filename, chunk_size):
+            self.bulk_load(keys, records)
+            progress["rows"] += len(keys)
+            progress["chunks"] += 1
+            progress["seconds"] = perf_counter() - start
+            progress["rows_per_sec"] = progress["rows"] / progress["seconds"]
+            if print_progress:
+                print(f"Chunk {progress['chunks']}: {progress['rows']} rows "
+                      f"in {progress['seconds']:.2f}s ({progress['rows_per_sec']:.0f} rows/s)")
+            yield dict(progress)
         
+    @timed("update_record")
     def update_record(self, new_item: tuple, start_node_id: int = None, print_item: bool = False) -> None:
         """Updates the record (value) of an item given its key."""
 
-        start_node = self.get_node(start_node_id)
-        responsible_node = start_node.find_successor(hash_func(new_item[0]))
+        pos = self.ring.hash_func(new_item[0])
+        responsible_node = self.lookup(pos, start_node_id)
         if new_item[0] in responsible_node.items:
-            responsible_node.insert_item_to_node(new_item, print_item=print_item)
+            old = responsible_node.items[new_item[0]] if self.indexes else None
+            responsible_node.insert_item_to_node(new_item, print_item=print_item, pos=pos)
+            if self.indexes:
+                self.apply_index_changes(self.index_changes({}, new_item[0], old, new_item[1]), start_node_id)
             return
         print(f"Could not find item with key {new_item[0]}")
         
@@ -99,10 +406,11 @@ class Interface:
         for n in sorted_nodes:
             n[1].print_node(finger_print=finger_print, items_print=items_print)
 
+    @timed("node_leave")
     def node_leave(self, node_id: int, start_node_id: int = None, print_node = False) -> None:
         """Removes node from network."""
 
-        node_to_remove = self.get_node(start_node_id).find_successor(node_id)
+        node_to_remove = self.find_successor(node_id, start_node_id)
         if node_to_remove.id != node_id:
             print(f"Node {node_id} not found.")
             return
@@ -111,16 +419,93 @@ class Interface:
             print("Node that will be removed from network:")
             node_to_remove.print_node(items_print=True)
             print(f"Successor node before {hex(node_id)} leave:")
-            successor = node_to_remove.f_table[0][1]
+            successor = node_to_remove.get_first_alive_succ()
             successor.print_node(items_print=True)
         
         node_to_remove.leave()
         del(self.nodes[node_id])
+        del(self.sorted_ids[bisect_left(self.sorted_ids, node_id)])
+        self.epoch += 1
 
         if print_node:
             print(f"Successor node after {hex(node_id)} leave:")
             successor.print_node(items_print=True)
 
+    @timed("fail_nodes")
+    def fail_nodes(self, fraction: float = None, node_ids: list[int] = None) -> list[int]:
+        """Crashes a fraction of the nodes (or the given ones) abruptly.
+        Failed nodes don't leave(), their items are lost and the pointers
+        of other nodes to them stay stale until stabilization.
+        At least one node is kept alive. Returns the failed ids."""
+
+        if node_ids is None:
+            count = min(int(len(self.sorted_ids) * fraction), len(self.sorted_ids) - 1)
+            node_ids = random.sample(self.sorted_ids, count)
+        failed = []
+        for node_id in node_ids:
+            if node_id in self.nodes and len(self.nodes) > 1:
+                self.nodes.pop(node_id).alive = False
+                failed.append(node_id)
+        failed_ids = set(failed)
+        self.sorted_ids = [node_id for node_id in self.sorted_ids if node_id not in failed_ids]
+        self.epoch += 1
+        return failed
+
+    @timed("stabilize_round")
+    def stabilize_round(self) -> None:
+        """Runs one stabilize/notify round and then fix_fingers
+        on every alive node, as Chord does periodically."""
+
+        for node_id in self.sorted_ids:
+            node = self.nodes[node_id]
+            node.fingers[0] = self.alive_successor(node)
+            node.stabilize()
+        for node_id in self.sorted_ids:
+            self.nodes[node_id].fix_fingers()
+
+    def heal(self, max_rounds: int = 100) -> int:
+        """Runs stabilization rounds until the ring is consistent again.
+        Returns the number of rounds needed, or None if it didn't heal."""
+
+        for rounds in range(max_rounds + 1):
+            if self.check_ring():
+                if self.ring.replicas:
+                    # Several failures in a row can leave windows stale
+                    for node_id in self.sorted_ids:
+                        self.nodes[node_id].refresh_replicas()
+                return rounds
+            self.stabilize_round()
+
+    def read_load(self) -> dict:
+        """Reads served per node and their spread, to compare
+        read policies under skewed workloads."""
+
+        reads = [self.nodes[node_id].reads for node_id in self.sorted_ids]
+        mean = sum(reads) / len(reads)
+        return {
+            "reads": sum(reads),
+            "min": min(reads),
+            "max": max(reads),
+            "mean": mean,
+            "stddev": (sum((count - mean) ** 2 for count in reads) / len(reads)) ** 0.5,
+            "max_over_mean": max(reads) / mean if mean else 0.0,
+            "per_node": dict(zip(self.sorted_ids, reads)),
+        }
+
+    def reset_read_load(self) -> None:
+        for node in self.nodes.values():
+            node.reads = 0
+
+    def enable_stats(self) -> Stats:
+        """Turns instrumentation on for the ring and returns its Stats."""
+
+        if self.ring.stats is None:
+            self.ring.stats = Stats()
+        return self.ring.stats
+
+    def disable_stats(self) -> None:
+        self.ring.stats = None
+
     def get_node(self, node_id: int = None) -> Node:
         """Returns node with id node_id. If it's not found,
         it returns the first node that joined the network."""
@@ -136,74 +521,180 @@ class Interface:
         # If nodes dictionary is not empty
         if self.nodes:
             # Return first inserted node
-            first_in_node = list(self.nodes.items())[0][1]
+            first_in_node = next(iter(self.nodes.values()))
             #print(f"Returning first inserted node with id: {hex(first_in_node.id)}")
             return first_in_node
 
+    @timed("range_query")
     def range_query(self, start: int, end:int, start_node_id: int = None) -> list[Node]:
         """Lists the nodes in the range [start, end]."""
 
-        nodes_in_range = []
-        first_node = self.get_node(start_node_id).find_successor(start)
+        return list(self.iter_range_query(start, end, start_node_id))
+
+    def iter_range_query(self, start: int, end: int, start_node_id: int = None):
+        """Yields the nodes in the range [start, end] lazily,
+        walking successors from the first one."""
+
+        first_node = self.find_successor(start, start_node_id)
         current = first_node
         
         # current id ∈ [start, end]
-        while cw_dist(start, end) >= cw_dist(current.id, end):
-            nodes_in_range.append(current)
-            current = current.f_table[0][1]
+        while self.ring.cw_dist(start, end) >= self.ring.cw_dist(current.id, end):
+            yield current
+            current = current.fingers[0]
             if (current == first_node):
-                return nodes_in_range
+                return
 
-        return nodes_in_range
-        
-        
-    def knn(self, k: int, node_id: int, start_node_id: int = None) -> list[Node]:
-        """Lists the k nearest nodes of node, given a specific id."""
+    def range_items(self, start, end, limit: int = None, start_node_id: int = None):
+        """Yields the (key, value) items with position ∈ [start, end]
+        in ring order, walking successors lazily, at most limit items.
+        start and end are ring positions, or keys when the ring has an
+        order-preserving key_encoder (e.g. Date_Plot keys)."""
 
-        neighbours = []
-        
-        node = self.exact_match(key=node_id ,start_node_id=start_node_id)
-        if node.id is None:
+        if limit is not None and limit <= 0:
             return
+        count = 0
+        for _, key, value in self.walk_items(self.key_position(start), self.key_position(end), start_node_id):
+            yield key, value
+            count += 1
+            if count == limit:
+                return
 
-        next_succ  = node.f_table[0][1]
+    def key_position(self, key) -> int:
+        """Ring position of a query bound, which is either a position
+        or a key of a ring with an order-preserving key_encoder."""
+
+        if isinstance(key, str):
+            if self.ring.key_encoder is None:
+                raise ValueError("Key ranges need a ring with an order-preserving key_encoder.")
+            return self.ring.hash_func(key)
+        return key
+
+    def walk_items(self, start: int, end: int, start_node_id: int = None):
+        """Yields the (position, key, value) items with position ∈ [start, end]
+        clockwise from start, visiting successors lazily."""
+
+        if not self.nodes:
+            return
+        ring = self.ring
+        # Positions as clockwise distances from start, the range is [0, span]
+        span = ring.cw_dist(start, end)
+        node = self.find_successor(start, start_node_id)
+        # Distance up to which items have been yielded, -1 before the first
+        done = -1
+        while done < span:
+            dist = ring.cw_dist(start, node.id)
+            # Back at the first node when the range wraps around its arc
+            upper = span if dist <= done else min(dist, span)
+            yield from self.node_range(node, (start + done) & ring.mask, (start + upper) & ring.mask)
+            done = upper
+            node = self.alive_successor(node)
+
+    def walk_items_back(self, start: int, end: int, start_node_id: int = None):
+        """Yields the (position, key, value) items with position ∈ [end, start]
+        counter-clockwise from start, visiting predecessors lazily."""
+
+        if not self.nodes:
+            return
+        ring = self.ring
+        # Positions as counter-clockwise distances from start, the range is [0, span]
+        span = ring.cw_dist(end, start)
+        node = self.find_successor(start, start_node_id)
+        # Distance up to which items have been yielded, -1 before the first
+        done = -1
+        while done < span:
+            pred = node.pred
+            # Not integrated by stabilization yet
+            if pred is None:
+                return
+            # The node's arc ends right after its predecessor, unless
+            # the walk wrapped around to the first node again
+            dist = ring.cw_dist(pred.id, start)
+            upper = span if dist <= done or pred is node else min(dist - 1, span)
+            yield from self.node_range(node, (start - upper - 1) & ring.mask, (start - done - 1) & ring.mask,
+                                       reverse=True)
+            done = upper
+            node = pred
+
+    def node_range(self, node: Node, lo: int, hi: int, reverse: bool = False):
+        """node's (position, key, value) items with position ∈ (lo, hi],
+        as ItemStore.iter_range, without the posting list items."""
+
+        items = node.items.iter_range(lo, hi, reverse)
+        return (item for item in items if not is_index_key(item[1])) if self.indexes else items
+
+    @timed("knn")
+    def knn(self, k: int, node_id: int, start_node_id: int = None) -> list[Node]:
+        """Lists the k nearest nodes of a key by ring distance, in order.
+        The key doesn't have to be a node id, a node with id equal to
+        the key isn't its own neighbour. One routed lookup, then the
+        successors and predecessors are merged outward."""
+
+        ring = self.ring
+        key = node_id
+        if not self.nodes:
+            return []
+        succ = self.find_successor(key, start_node_id)
+        next_succ, next_pred = succ, succ.pred
+        others = len(self.nodes)
+        if succ.id == key:
+            next_succ = succ.fingers[0]
+            others -= 1
+
+        neighbours = []
         succ_hops = 0
-        next_pred = node.pred
         pred_hops = 0
-
-        while len(neighbours) < k:
-            # Difference of next_succ and next_pred distance from node
-            succ_pred_difference = (abs(node_id - next_succ.id) % HS) - (abs(node_id - next_pred.id) % HS)
-            
-            # Next successor is closer
-            if succ_pred_difference < 0:
+        # The two walks can't overlap while fewer than all nodes are taken
+        for _ in range(min(k, others)):
+            succ_dist = min(ring.cw_dist(key, next_succ.id), ring.cw_dist(next_succ.id, key))
+            pred_dist = min(ring.cw_dist(key, next_pred.id), ring.cw_dist(next_pred.id, key))
+            # Equal distance goes to the side with fewer hops, successor first
+            if succ_dist < pred_dist or succ_dist == pred_dist and succ_hops <= pred_hops:
                 neighbours.append(next_succ)
-                next_succ = next_succ.f_table[0][1]
+                next_succ = next_succ.fingers[0]
                 succ_hops += 1
-
-            # Next predecessor is closer
-            elif succ_pred_difference > 0:
+            else:
                 neighbours.append(next_pred)
                 next_pred = next_pred.pred
                 pred_hops += 1
-            
-            # Equal distance
-            else:
-                if succ_hops <= pred_hops:
-                    neighbours.append(next_succ)
-                    next_succ = next_succ.f_table[0][1]
-                    succ_hops += 1
-                else:
-                    neighbours.append(next_pred)
-                    next_pred = next_pred.pred
-                    pred_hops += 1
-        
+
         return neighbours
 
+    @timed("knn_items")
+    def knn_items(self, k: int, key, start_node_id: int = None) -> list[tuple]:
+        """Lists the k (key, value) items nearest to a position (or a key
+        of a ring with an order-preserving key_encoder) by ring distance,
+        merging the items clockwise and counter-clockwise of it."""
+
+        ring = self.ring
+        pos = self.key_position(key)
+        forward = self.walk_items(pos, (pos - 1) & ring.mask, start_node_id)
+        backward = self.walk_items_back((pos - 1) & ring.mask, pos, start_node_id)
+        next_forward = next(forward, None)
+        next_backward = next(backward, None)
+
+        nearest = []
+        seen = set()
+        while len(nearest) < k and (next_forward is not None or next_backward is not None):
+            forward_dist = ring.cw_dist(pos, next_forward[0]) if next_forward is not None else ring.hs
+            backward_dist = ring.cw_dist(next_backward[0], pos) if next_backward is not None else ring.hs
+            if forward_dist <= backward_dist:
+                item, next_forward = next_forward, next(forward, None)
+            else:
+                item, next_backward = next_backward, next(backward, None)
+            # The walks meet on the far side of the ring
+            if item[1] in seen:
+                break
+            seen.add(item[1])
+            nearest.append((item[1], item[2]))
+
+        return nearest
+
+    @timed("exact_match")
     def exact_match(self, key: int, start_node_id: int = None) -> Node  | None:
         """Finds and returns node with id same as a given key, if it exists."""
 
-        node = self.get_node(start_node_id).find_successor(key)
+        node = self.find_successor(key, start_node_id)
         if node.id != key:
             print(f"Couldn't find node with id {key}.")
             return
@@ -212,12 +703,258 @@ class Interface:
     def get_random_node(self) -> Node:
         """Returns random node in the network."""
 
-        random_key = random.sample(sorted(self.nodes), 1)[0]
-        return self.nodes[random_key]
+        return self.nodes[random.choice(self.sorted_ids)]
     
+    def split_point(self) -> int:
+        """Returns a free id that splits the arc of the node holding the
+        most items in half (by items, or by length if it holds less
+        than 2), or None if no loaded arc can be split."""
+
+        ring = self.ring
+        if not self.nodes:
+            return random.randrange(ring.hs)
+        for node in sorted(self.nodes.values(), key=lambda node: len(node.items), reverse=True):
+            pred_id = node.pred.id if node.pred is not None else node.id
+            # Positions in clockwise order from the predecessor
+            positions = sorted(node.items.positions, key=lambda pos: ring.cw_dist(pred_id, pos))
+            candidates = []
+            if len(positions) >= 2:
+                # The new node takes the first half of the items
+                candidates.append(positions[(len(positions) - 1) // 2])
+            # The whole ring when the node is alone
+            arc = ring.cw_dist(pred_id, node.id) or ring.hs
+            candidates.append((pred_id + arc // 2) & ring.mask)
+            for candidate in candidates:
+                if candidate not in self.nodes:
+                    return candidate
+
+    def balanced_join(self, vnodes: int = 1, print_node: bool = False) -> int:
+        """Joins a new physical node with vnodes ring positions, each one
+        splitting the currently most loaded arc. Returns its id."""
+
+        physical = None
+        for _ in range(vnodes):
+            node_id = self.split_point()
+            if node_id is None:
+                break
+            self.node_join(node_id, print_node=print_node, owner=physical)
+            if physical is None:
+                physical = node_id
+        return physical
+
+    def physical_leave(self, owner: int) -> None:
+        """Removes a physical node, i.e. all of its virtual nodes."""
+
+        for node_id in [node.id for node in self.nodes.values() if node.owner == owner]:
+            self.node_leave(node_id, start_node_id=node_id)
+
+    def load_report(self) -> dict:
+        """Items per physical node (summed over its virtual nodes)
+        and their spread."""
+
+        counts = {}
+        for node in self.nodes.values():
+            counts[node.owner] = counts.get(node.owner, 0) + len(node.items)
+        loads = list(counts.values())
+        mean = sum(loads) / len(loads)
+        return {
+            "physical_nodes": len(loads),
+            "virtual_nodes": len(self.nodes),
+            "items": sum(loads),
+            "min": min(loads),
+            "max": max(loads),
+            "mean": mean,
+            "stddev": (sum((count - mean) ** 2 for count in loads) / len(loads)) ** 0.5,
+            "max_over_mean": max(loads) / mean if mean else 0.0,
+        }
+
+    @timed("aggregate")
+    def aggregate(self, field: str, group_by: str = None) -> dict:
+        """Count, sum, mean, min and max of a numeric record field, per
+        value of group_by (or under None), e.g. the mean Soil_NH4 per
+        Experimental_treatment. Each node computes partials over its own
+        items (vectorized on columnar stores), only those are merged."""
+
+        total = {}
+        for node in list(self.nodes.values()):
+            if node.alive:
+                merge_partials(total, self.node_partial(node, field, group_by))
+        return {group: {"count": count, "sum": value_sum, "mean": value_sum / count, "min": value_min, "max": value_max}
+                for group, (count, value_sum, value_min, value_max) in total.items()}
+
+    def node_partial(self, node: Node, field: str, group_by: str = None) -> dict:
+        return node.aggregate(field, group_by)
+
+    def create_index(self, field: str, kind: str = "value") -> None:
+        """Declares a secondary index on a record field. Its posting lists
+        are items of the ring, under the hashed index key of each value
+        (index_key), kept up to date by the insert/update/delete methods.
+        Items already in the ring are indexed with one pass over the nodes."""
+
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Index kind must be one of {INDEX_KINDS}, got {kind}.")
+        if field in self.indexes:
+            return
+        self.indexes[field] = kind
+        changes = {}
+        for node in self.nodes.values():
+            if node.alive:
+                for key, value in node.items.items():
+                    if not is_index_key(key):
+                        self.index_changes(changes, key, None, value, [field])
+        self.apply_index_changes(changes)
+
+    def index_key(self, field: str, value) -> str:
+        """Key of the posting list holding value. Date indexes
+        keep one posting list per month, for date ranges."""
+
+        if self.indexes[field] == "date":
+            date = datetime.strptime(value, "%m/%d/%Y")
+            value = f"{date.year}-{date.month:02d}"
+        return f"{INDEX_PREFIX}{field}={value}"
+
+    def index_changes(self, changes: dict, key: str, old, new, fields: list[str] = None) -> dict:
+        """Adds the posting list changes of key's record going from old
+        to new (None if absent) to changes, {index key: (added, removed)}.
+        Posting lists map keys to None, or to their date's ordinal."""
+
+        for field in fields if fields is not None else self.indexes:
+            old_value = old.get(field) if isinstance(old, dict) else None
+            new_value = new.get(field) if isinstance(new, dict) else None
+            if old_value == new_value:
+                continue
+            if old_value is not None:
+                changes.setdefault(self.index_key(field, old_value), ({}, set()))[1].add(key)
+            if new_value is not None:
+                entry = date_ordinal(new_value) if self.indexes[field] == "date" else None
+                changes.setdefault(self.index_key(field, new_value), ({}, set()))[0][key] = entry
+        return changes
+
+    def apply_index_changes(self, changes: dict, start_node_id: int = None) -> None:
+        """Updates the posting lists with one batched lookup, their
+        nodes are found together. Emptied posting lists are deleted."""
+
+        if not changes:
+            return
+        positions = {index_key: self.ring.sha1_hash(index_key) for index_key in changes}
+        owners = self.find_successor_many(set(positions.values()), start_node_id)
+        for index_key, (added, removed) in changes.items():
+            self.update_posting(owners[positions[index_key]], index_key, positions[index_key], added, removed)
+
+    def update_posting(self, node: Node, index_key: str, pos: int, added: dict, removed: set) -> None:
+        posting = node.items[index_key] if index_key in node.items else {}
+        for key in removed:
+            posting.pop(key, None)
+        posting.update(added)
+        if posting:
+            node.insert_item_to_node((index_key, posting), pos=pos)
+        elif index_key in node.items:
+            node.delete_item_from_node(index_key)
+
+    def posting_list(self, index_key: str, start_node_id: int = None) -> dict:
+        node = self.lookup(self.ring.sha1_hash(index_key), start_node_id)
+        return node.items[index_key] if index_key in node.items else {}
+
+    @timed("index_lookup")
+    def index_lookup(self, field: str, value, start_node_id: int = None) -> list[str]:
+        """Keys of the items whose field equals value, from their
+        posting list in one routed lookup."""
+
+        if field not in self.indexes:
+            raise ValueError(f"No index on {field}, create_index() it first.")
+        if self.indexes[field] == "date":
+            return self.date_range_lookup(field, value, value, start_node_id)
+        return sorted(self.posting_list(self.index_key(field, value), start_node_id))
+
+    @timed("date_range_lookup")
+    def date_range_lookup(self, field: str, start: str, end: str, start_node_id: int = None) -> list[str]:
+        """Keys of the items whose date field ∈ [start, end] (M/D/YYYY),
+        in date order. One routed lookup per month of the range."""
+
+        if self.indexes.get(field) != "date":
+            raise ValueError(f"No date index on {field}, create_index({field!r}, 'date') it first.")
+        lo, hi = date_ordinal(start), date_ordinal(end)
+        first, last = datetime.strptime(start, "%m/%d/%Y"), datetime.strptime(end, "%m/%d/%Y")
+        year, month = first.year, first.month
+        found = []
+        while (year, month) <= (last.year, last.month):
+            posting = self.posting_list(self.index_key(field, f"{month}/1/{year}"), start_node_id)
+            found.extend((ordinal, key) for key, ordinal in posting.items() if lo <= ordinal <= hi)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        found.sort()
+        return [key for _, key in found]
+
+    def get_items(self, keys: list[str], start_node_id: int = None) -> list:
+        """Records of many keys with one batched lookup, None if missing.
+        E.g. get_items(index_lookup(field, value))."""
+
+        keys = list(keys)
+        positions = [self.ring.hash_func(key) for key in keys]
+        owners = self.find_successor_many(positions, start_node_id)
+        return [owners[pos].read(key) for key, pos in zip(keys, positions)]
+
     def get_id_not_in_net(self) -> int:
-        """Returns node id that doesn't already exist in the network."""
+        """Returns the lowest node id that doesn't already exist in the network."""
+
+        ids = self.sorted_ids
+        if len(ids) == self.ring.hs:
+            return
+        # ids are distinct and sorted, so ids[i] == i holds for a prefix
+        # of the list. Binary search for the first index breaking it.
+        lo, hi = 0, len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ids[mid] == mid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
 
-        for i in range(HS):
-            if i not in self.nodes:
-                return i
\ No newline at end of file
+    def successor_id(self, key: int) -> int:
+        """Returns the id of the node responsible for key,
+        using the sorted id index instead of routing."""
+
+        if not self.sorted_ids:
+            return
+        i = bisect_left(self.sorted_ids, key)
+        return self.sorted_ids[i % len(self.sorted_ids)]
+
+    def predecessor_id(self, key: int) -> int:
+        """Returns the id of the last node strictly before key."""
+
+        if not self.sorted_ids:
+            return
+        return self.sorted_ids[bisect_left(self.sorted_ids, key) - 1]
+
+    def check_successor(self, key: int, start_node_id: int = None) -> bool:
+        """Checks the routed find_successor against the sorted id index."""
+
+        routed = self.get_node(start_node_id).find_successor(key)
+        return routed is not None and routed.id == self.successor_id(key)
+
+    def check_ring(self, print_errors: bool = False) -> bool:
+        """Checks every predecessor, finger table and successor list
+        against a freshly built ring with the same node ids."""
+
+        ids = self.sorted_ids
+        errors = []
+        for index, node_id in enumerate(ids):
+            node = self.nodes[node_id]
+            if node.pred is None:
+                errors.append(f"{hex(node_id)}: no predecessor, expected {hex(ids[index - 1])}")
+            elif node.pred.id != ids[index - 1]:
+                errors.append(f"{hex(node_id)}: predecessor {hex(node.pred.id)}, expected {hex(ids[index - 1])}")
+            for i, finger in enumerate(node.fingers):
+                expected = self.successor_id(self.ring.finger_pos(node_id, i))
+                if finger.id != expected:
+                    errors.append(f"{hex(node_id)}: finger {i} {hex(finger.id)}, expected {hex(expected)}")
+            if len(node.fingers) != self.ring.ks:
+                errors.append(f"{hex(node_id)}: {len(node.fingers)} fingers, expected {self.ring.ks}")
+            expected = [ids[(index + i) % len(ids)] for i in range(1, min(self.ring.sls, len(ids) - 1) + 1)]
+            if [succ.id for succ in node.succ_list] != expected:
+                errors.append(f"{hex(node_id)}: successor list {[hex(succ.id) for succ in node.succ_list]}, "
+                              f"expected {[hex(succ_id) for succ_id in expected]}")
+        if print_errors:
+            for error in errors:
+                print(error)
+        return not errors
@@ -1,10 +1,9 @@
 import interface as iff
+from config import RingConfig
 import random
 
 # Key size (bits)
 KS = 4
-# Hashing space
-HS = 2**KS
 # Successor list size
 SLS = 3
 # Node count
@@ -12,7 +11,7 @@ NC = 5
 
 def main():
     # Nodes creation
-    interface = iff.Interface()
+    interface = iff.Interface(RingConfig(ks=KS, sls=SLS))
     
     # Create random network with NC nodes
     interface.build_network(NC)
@@ -1,84 +1,167 @@
-from xmlrpc.client import boolean
-from main import KS, HS, SLS
-import hashlib
-
-def hash_func(data) -> int:
-    hash_out = hashlib.sha1()
-    hash_out.update(bytes(data.encode("utf-8")))
-    return int(hash_out.hexdigest(), 16) % HS
-
-def cw_dist(k1: int, k2: int) -> int:
-    """Clockwise distance of 2 keys"""
-    
-    if k1 <= k2:
-        return k2 - k1
-    else:
-        return (HS) + (k2 - k1)
-
-def comp_cw_dist(k1: int, k2: int, dest: int) -> bool:
-    """Returns true if clockwise distance of k1 from dest
-    is bigger than clockwise distance of k2 from dest.
-    In other words, k2 ∈ (k1, dest]"""
-
-    if cw_dist(k1, dest) > cw_dist(k2, dest):
-        return True
-    return False
+from config import RingConfig
+from columns import ColumnarItemStore, aggregate_partial, make_store
+from bisect import bisect_left
+
+def build_tables(ring: RingConfig, ids: list[int], indices, node_at) -> None:
+    """Sets the predecessor, finger table and successor list of the nodes
+    at indices of the sorted ids, the same as if every node had joined
+    one by one. node_at(j) returns the Node of ids[j % len(ids)]."""
+
+    count = len(ids)
+    for j in indices:
+        node = node_at(j)
+        node.pred = node_at(j - 1)
+        succ = node_at(j + 1)
+        # Fingers up to the successor need no search
+        gap = ring.cw_dist(node.id, succ.id) or ring.hs
+        node.fingers = [succ if offset <= gap else node_at(bisect_left(ids, (node.id + offset) & ring.mask))
+                        for offset in ring.offsets]
+        node.succ_list = [node_at(j + i) for i in range(1, min(ring.sls, count - 1) + 1)]
 
 class Node:
-    def __init__(self, id: int, pred=None) -> None:
+    # No per-node __dict__, rings can hold 10^5+ nodes
+    __slots__ = ("id", "ring", "items", "fingers", "pred", "succ_list", "alive", "replicas", "reads", "owner")
+
+    def __init__(self, id: int, ring: RingConfig, pred=None) -> None:
         self.id = id
-        # List of dictionaries
-        self.items = {}
-        # list(table) of lists of the form: [position, node]
-        self.f_table = []
+        self.ring = ring
+        # Items ordered by hashed key position
+        self.items = make_store(ring)
+        # Finger table nodes. The position of entry i is
+        # ring.finger_pos(id, i), so it's computed instead of stored.
+        self.fingers = []
         self.pred = pred
-        self.succ_list = [None for r in range(SLS)]
+        # Up to ring.sls successors
+        self.succ_list = []
+        # False once the node has crashed
+        self.alive = True
+        # Copies of the items of the ring.replicas predecessors
+        self.replicas = make_store(ring) if ring.replicas else None
+        # Reads served, for the read load report
+        self.reads = 0
+        # Id of the physical node this (virtual) node belongs to
+        self.owner = id
 
     def closest_pre_node(self, key: int) -> 'Node':
         """Returns the last predecessor from THIS node's finger table"""
 
+        comp_cw_dist = self.ring.comp_cw_dist
         current = self
-        for i in range(KS):
-            # current.successor ∈ (current, key]
-            if comp_cw_dist(current.id, current.f_table[i][1].id, key):
-                current = current.f_table[i][1]
+        for i in range(self.ring.ks):
+            finger = current.fingers[i]
+            # current.successor ∈ (current, key], skipping failed nodes
+            if finger.alive and comp_cw_dist(current.id, finger.id, key):
+                current = finger
         return current
 
     def find_successor(self, key: int) -> 'Node':
         """Returns the node with the shortest
         clockwise distance from the given key"""
 
-        current = self.closest_pre_node(key)
-        next = current.closest_pre_node(key)
+        return self.route(key)[0]
 
-        while comp_cw_dist(current.id, next.id, key):
-            current = next
-            next = current.closest_pre_node(key)
+    def route(self, key: int) -> tuple['Node', int]:
+        """find_successor that also returns the number of hops
+        (forwards from node to node) the lookup took.
+        Failed fingers are detoured through the successor list."""
 
-        if current.id == key:
-            return current
+        comp_cw_dist = self.ring.comp_cw_dist
+        ks = self.ring.ks
+        hops = 0
+        rounds = 0
+        current = self
+        # Same walk as repeated closest_pre_node calls, until no finger
+        # gets closer to key
+        while True:
+            start = current
+            rounds += 1
+            for i in range(ks):
+                finger = current.fingers[i]
+                if finger.alive and comp_cw_dist(current.id, finger.id, key):
+                    current = finger
+                    hops += 1
+            if current is start:
+                break
 
-        return current.f_table[0][1]
+        if current.id != key:
+            current = current.get_first_alive_succ()
+            hops += 1
+
+        stats = self.ring.stats
+        if stats is not None:
+            stats.observe("lookup_hops", hops)
+            stats.observe("finger_comparisons", rounds * ks)
+        return current, hops
+
+    def find_successor_many(self, keys) -> dict:
+        """Returns a {key: responsible node} mapping for many keys.
+        Keys are sorted by clockwise distance from this node and routed
+        together, so keys in the same arc share their finger hops.
+        Keys routed to a node with no alive successor map to None."""
+
+        cw_dist = self.ring.cw_dist
+        result = {}
+        pending = [(self, sorted(set(keys), key=lambda k: cw_dist(self.id, k)))]
+        while pending:
+            node, group = pending.pop()
+            succ = node.get_first_alive_succ()
+            if succ is None:
+                # Cut off from the ring, as find_successor returning None
+                result.update(dict.fromkeys(group))
+                continue
+            # A single node is responsible for the whole ring
+            succ_dist = cw_dist(node.id, succ.id) or self.ring.hs
+
+            # Distinct fingers past the successor, ordered by distance
+            hops = []
+            for finger in node.fingers:
+                dist = cw_dist(node.id, finger.id)
+                if finger.alive and dist > succ_dist and (not hops or dist > hops[-1][0]):
+                    hops.append((dist, finger))
+
+            h = -1
+            forward = []
+            for key in group:
+                dist = cw_dist(node.id, key)
+                if dist == 0:
+                    result[key] = node
+                    continue
+                if dist <= succ_dist:
+                    result[key] = succ
+                    continue
+                # Closest preceding finger: furthest hop with distance < dist
+                while h + 1 < len(hops) and hops[h + 1][0] < dist:
+                    h += 1
+                next_hop = hops[h][1] if h >= 0 else succ
+                if forward and forward[-1][0] is next_hop:
+                    forward[-1][1].append(key)
+                else:
+                    forward.append((next_hop, [key]))
+            pending.extend(forward)
+
+        return result
 
     def fix_fingers(self) -> None:
         """Called periodically.
         Refreshes finger table entries."""
 
-        for i in range(KS - 1):
-            next_in_finger = self.f_table[i + 1]
-            next_in_finger[1] = self.f_table[i][1].find_successor(next_in_finger[0])
+        fingers = self.fingers
+        finger_pos = self.ring.finger_pos
+        for i in range(self.ring.ks - 1):
+            start = fingers[i] if fingers[i].alive else self
+            fingers[i + 1] = start.find_successor(finger_pos(self.id, i + 1)) or fingers[i]
         #self.print_node()
 
     def fix_successor_list(self) -> None:
         """Called periodically.
         Refreshes successor list."""
 
-        next_successor = self
-        for i in range(SLS):
-            if next_successor.f_table[0][1] == self:
-                break
-            self.succ_list[i] = next_successor.f_table[0][1]
-            next_successor = next_successor.f_table[0][1]
+        succ_list = []
+        next_successor = self.fingers[0]
+        while len(succ_list) < self.ring.sls and next_successor != self:
+            succ_list.append(next_successor)
+            next_successor = next_successor.fingers[0]
+        self.succ_list = succ_list
 
     def insert_new_pred(self, new_n: 'Node') -> None:
         """Inserts new node to the network as this node's predecessor.
@@ -88,28 +171,42 @@ class Node:
         #self.pred.print_node(items_print=True)
 
         # New node's successor is this node
-        new_n.f_table.append([(new_n.id + 1) % (HS), self])
+        new_n.fingers.append(self)
         # Predecessor's new successor is the new node
-        self.pred.f_table[0][1] = new_n
+        self.pred.fingers[0] = new_n
         # New node's predecessor is this node's predecessor
         new_n.pred = self.pred
         # This node's predecessor is the new node
         self.pred = new_n
 
-        self.move_items_to_pred()
+        moved = self.move_items_to_pred()
         new_n.initialize_finger_table()
         new_n.fix_successor_list()
-        new_n.update_necessary_fingers(joinning=True)
+        repaired = new_n.repair_fingers(new_n, new_n.pred.id)
+        new_n.fix_pred_successor_lists()
+        if self.ring.replicas:
+            new_n.refresh_replicas()
+            self.refresh_replica_window()
+
+        stats = self.ring.stats
+        if stats is not None:
+            stats.count("joins")
+            stats.observe("items_moved_join", moved)
+            stats.observe("fingers_repaired_join", repaired)
                         
         #print("Predecessor node AFTER node join:")
         #new_n.pred.print_node(items_print=True)
 
-    def insert_item_to_node(self, new_item: tuple, print_item=False) -> None:
-        """Insert data in the node."""
+    def insert_item_to_node(self, new_item: tuple, print_item=False, pos: int = None) -> None:
+        """Insert data in the node. pos is the item's hashed key, if known."""
         
         if print_item:
             print(f"Item with key {new_item[0]} before updating record:\n{self.items[new_item[0]]}")
-        self.items[new_item[0]] = new_item[1]
+        self.items.put(new_item[0], new_item[1], pos)
+        if self.ring.replicas:
+            pos = self.items.position(new_item[0])
+            for succ in self.replica_holders():
+                succ.replicas.put(new_item[0], new_item[1], pos)
         if print_item:
             print(f"Item with key {new_item[0]} after updating record:\n{self.items[new_item[0]]}")
 
@@ -118,123 +215,253 @@ class Node:
             if item_print:
                 print(f"Node before removing item with key {key}:")
                 self.print_node(items_print=True)
-            del(self.items[key])
+            self.items.remove(key)
+            if self.ring.replicas:
+                for succ in self.replica_holders():
+                    if key in succ.replicas:
+                        succ.replicas.remove(key)
             if item_print:
                 print(f"Node after removing item with key {key}:")
                 self.print_node(items_print=True)
             return
         print(f"Key {key} not found") 
 
-    def move_items_to_pred(self) -> None:    
+    def move_items_to_pred(self) -> int:    
         """Moves node's items to predecessor.
         Used after a new node joins the network.
-        Assumes all predecessors are up to date."""
+        Assumes all predecessors are up to date.
+        Returns the number of items moved."""
 
-        for key in sorted(self.items):
-            # key ∉ (previous predecessor, new node (current predecessor)]
-            if not comp_cw_dist(self.pred.pred.id, hash_func(key), self.pred.id):
-                break
-            self.pred.items[key] = self.items[key]
-            del self.items[key]
+        # Items with position ∈ (previous predecessor, new node (current predecessor)]
+        moved = self.items.split(self.pred.pred.id, self.pred.id)
+        count = len(moved)
+        self.pred.items.merge(moved)
+        return count
 
     def initialize_finger_table(self) -> None:
         """Initialize node's finger table.
         Assumes node's successor is up to date."""
 
+        ks = self.ring.ks
+        comp_cw_dist = self.ring.comp_cw_dist
+        finger_pos = self.ring.finger_pos
         i = 1
-        while i < KS:
-            pos = (self.id + (2**i)) % (HS)
+        while i < ks:
+            pos = finger_pos(self.id, i)
 
             # While pos ∈ (new_n.id, new_n.successor]
-            while (i < KS) and comp_cw_dist(self.id, pos, self.f_table[0][1].id):
+            while comp_cw_dist(self.id, pos, self.fingers[0].id):
                 # new_n [i] = new_n.successor
-                self.f_table.append([pos, self.f_table[0][1]])
+                self.fingers.append(self.fingers[0])
                 i += 1
-                pos = (self.id + (2**i)) % (HS)
+                if i == ks:
+                    break
+                pos = finger_pos(self.id, i)
 
-            if i == KS:
+            if i == ks:
                 break
 
-            self.f_table.append([pos, self.f_table[0][1].find_successor(pos)])
+            self.fingers.append(self.fingers[0].find_successor(pos))
             i += 1
 
     def leave(self) -> None:
         """Removes node from the network."""
 
+        # Failed successors would take the items down with them
+        successor = self.get_first_alive_succ()
+        # Last node of the network
+        if successor is None or successor is self:
+            return
+        if self.ring.replicas and successor is not self.fingers[0]:
+            # Take over the items of the failed nodes in between from the replicas
+            promoted = successor.replicas.split(self.id, successor.id)
+            successor.items.put_sorted(promoted.keys_list, promoted.values(), promoted.positions)
         # Move all keys to successor node
-        self.f_table[0][1].items = self.f_table[0][1].items | self.items
+        moved = len(self.items)
+        successor.items.merge(self.items)
         # Update successor's predecessor
-        self.f_table[0][1].pred = self.pred
+        successor.pred = self.pred
         # Update predecessor's successor
-        self.pred.f_table[0][1] = self.f_table[0][1]
-
-        self.update_necessary_fingers()
+        self.pred.fingers[0] = successor
+
+        repaired = self.repair_fingers(successor, self.pred.id)
+        self.fix_pred_successor_lists()
+        if self.ring.replicas:
+            successor.refresh_replica_window()
+
+        stats = self.ring.stats
+        if stats is not None:
+            stats.count("leaves")
+            stats.observe("items_moved_leave", moved)
+            stats.observe("fingers_repaired_leave", repaired)
+        # Stale pointers to a departed node are skipped like failed ones
+        self.alive = False
     
-    def calc_furth_poss_pred(self) -> int:
-        """Calculates the furthest possible predecessor id whose 
-        last finger table entry position is equal to or higher
-        than the current node's ID."""
+    def repair_fingers(self, target: 'Node', arc_start: int) -> int:
+        """Points every finger whose position ∈ (arc_start, self] to target.
+        On join self is the new node and target is self, on leave target
+        is self's successor. Only those (node, finger index) pairs change,
+        finger i of node m does iff m ∈ (arc_start - 2^i, self - 2^i].
+        Returns the number of fingers updated."""
+
+        ring = self.ring
+        comp_cw_dist = ring.comp_cw_dist
+        updated = 0
+        for i in range(ring.ks):
+            lo = (arc_start - ring.offsets[i]) & ring.mask
+            hi = (self.id - ring.offsets[i]) & ring.mask
+            # Last node at or before hi
+            first = self.find_successor(hi)
+            if first.id != hi:
+                first = first.pred
+            node = first
+            # node.id ∈ (lo, hi]
+            while node is not None and comp_cw_dist(lo, node.id, hi):
+                node.fingers[i] = target
+                updated += 1
+                node = node.pred
+                if node is first:
+                    break
+        return updated
+
+    def fix_pred_successor_lists(self) -> None:
+        """Refreshes the successor lists of the nodes
+        whose list can contain this node."""
+
+        node = self.pred
+        for i in range(self.ring.sls):
+            if node is None or node is self:
+                break
+            node.fix_successor_list()
+            node = node.pred
 
-        if self.id >= 2**(KS-1):
-            return self.id - (2**(KS-1))
+    def stabilize(self) -> None:
+        """Called periodically.
+        Verifies this node's successor, skipping failed ones,
+        and tells the successor about this node."""
 
-        return 2**KS + (self.id-(2**(KS-1)))
+        succ = self.get_first_alive_succ()
+        if succ is None:
+            return
+        # succ.pred ∈ (self, succ), the whole ring when a lone node is
+        # its own successor and a node joined in front of it
+        candidate = succ.pred
+        if candidate is not None and candidate.alive and candidate is not succ \
+                and (succ is self or self.ring.comp_cw_dist(self.id, candidate.id, succ.id)):
+            succ = candidate
+        if succ is self:
+            return
+        self.fingers[0] = succ
+        self.succ_list = ([succ] + [node for node in succ.succ_list
+                                    if node.alive and node is not self])[:self.ring.sls]
+        succ.notify(self)
+
+    def notify(self, node: 'Node') -> None:
+        """node thinks it might be this node's predecessor."""
+
+        # node ∈ (pred, self), the whole ring for a lone node, or predecessor failed
+        if self.pred is None or not self.pred.alive \
+                or (self.pred is self or self.ring.comp_cw_dist(self.pred.id, node.id, self.id)) and node is not self:
+            if self.ring.replicas and self.pred is not None and not self.pred.alive:
+                # Take over the failed predecessors' items from the replicas
+                promoted = self.replicas.split(node.id, self.id)
+                self.items.put_sorted(promoted.keys_list, promoted.values(), promoted.positions)
+            # Items ∉ (node, self] now belong to node
+            moved = self.items.split(self.id, node.id)
+            if self.ring.stats is not None:
+                self.ring.stats.observe("items_moved_notify", len(moved))
+            node.items.merge(moved)
+            self.pred = node
+            self.ring.epoch += 1
+            if self.ring.replicas:
+                node.refresh_replicas()
+                self.refresh_replica_window()
+
+    def replica_holders(self) -> list['Node']:
+        """Alive successors that keep copies of this node's items."""
+
+        return [succ for succ in self.succ_list[:self.ring.replicas] if succ.alive]
+
+    def refresh_replicas(self) -> None:
+        """Rebuilds the replicas from the items of the ring.replicas
+        predecessors, the arc (r+1-th predecessor, predecessor]."""
+
+        replicas = make_store(self.ring)
+        node = self.pred
+        for _ in range(self.ring.replicas):
+            if node is None or node is self or not node.alive:
+                break
+            replicas.merge(node.items.copy())
+            node = node.pred
+        self.replicas = replicas
 
-    def update_necessary_fingers(self, joinning = False) -> None:
-        """Updates necessary finger tables on node join/leave"""
+    def refresh_replica_window(self) -> None:
+        """Refreshes the replicas of this node and of the successors
+        whose predecessor window contains it, after this node's arc
+        or predecessor changed."""
 
-        furthest_possible_pred_id = self.calc_furth_poss_pred()
-        next_pred = self.pred
-        if next_pred == self or next_pred is None:
-            return
+        self.refresh_replicas()
+        for succ in self.succ_list[:self.ring.replicas]:
+            succ.refresh_replicas()
 
-        i = 0
-        # next_pred.id ∈ (furthest_possible_pred_id, self]
-        while comp_cw_dist(furthest_possible_pred_id, next_pred.id, self.id):
-            next_pred.fix_fingers()
-            if i < SLS:
-                next_pred.fix_successor_list()
-                i += 1
-            next_pred = next_pred.pred
-            if next_pred == self or next_pred is None:
-                return
-            
-        if not joinning:
-            comp = self
-        else:
-            comp = self.f_table[0][1]
-
-        # next_pred last = current node
-        while next_pred.f_table[KS-1][1] == comp:
-            next_pred.fix_fingers()
-            next_pred = next_pred.pred
-            if next_pred == self or next_pred is None:
-                return
+    def read(self, key: str):
+        """Serves a read of key from the items or the replicas,
+        counting it in the node's read load."""
+
+        self.reads += 1
+        if key in self.items:
+            return self.items[key]
+        if self.replicas is not None and key in self.replicas:
+            return self.replicas[key]
+
+    def aggregate(self, field: str, group_by: str = None) -> dict:
+        """Partial aggregate of field over this node's own items,
+        {group: [count, sum, min, max]}."""
+
+        if isinstance(self.items, ColumnarItemStore):
+            return self.items.partial(field, group_by)
+        return aggregate_partial(self.items.values(), field, group_by)
+
+    def join(self, known: 'Node') -> None:
+        """Joins the network through known, as in Chord. Only the
+        successor is set, stabilize/notify fix the predecessors and
+        move the items, fix_finger fills in the finger table."""
+
+        succ = known.find_successor(self.id)
+        self.pred = None
+        self.fingers = [succ] * self.ring.ks
+        self.succ_list = [succ]
+
+    def fix_finger(self, i: int) -> None:
+        """Called periodically, refreshes finger table entry i."""
+
+        self.fingers[i] = self.find_successor(self.ring.finger_pos(self.id, i)) or self.fingers[i]
 
     def print_node(self, items_print = False, finger_print = False) -> None:
         print(f"Node ID: {hex(self.id)}")
-        print(f"Predecessor ID: {hex(self.pred.id)}")
+        print(f"Predecessor ID: {hex(self.pred.id) if self.pred is not None else None}")
         self.print_succ()
         if items_print:
             print(f"Items in node: {[key for key in self.items.keys()]}")
         if finger_print:
             print("Finger table:")
-            for entry in self.f_table:
-                print(f"{hex(entry[0])} -> {hex(entry[1].id)}")
+            for i, finger in enumerate(self.fingers):
+                print(f"{hex(self.ring.finger_pos(self.id, i))} -> {hex(finger.id)}")
         print()
 
     def print_succ(self):
-        true_succ = []
-        for succ in self.succ_list:
-            if succ is None:
-                break
-            true_succ.append(hex(succ.id))
-        print(f"Successor list: {true_succ}")
+        print(f"Successor list: {[hex(succ.id) for succ in self.succ_list]}")
     
     def get_first_alive_succ(self) -> 'Node':
         """Returns first successor that hasn't failed"""
 
+        if self.fingers[0].alive:
+            return self.fingers[0]
         for succ in self.succ_list:
-            if succ is not None:
+            if succ.alive:
                 return succ
+        # Whole successor list failed, fall back to the closest alive finger
+        for finger in self.fingers:
+            if finger.alive:
+                return finger
         return
\ No newline at end of file
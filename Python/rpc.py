@@ -0,0 +1,331 @@
+from interface import Interface
+from config import RingConfig
+from node import Node
+from time import perf_counter
+import asyncio
+import json
+import random
+
+# Requests and responses are single JSON lines:
+# [method, args] -> {"result": ...} or {"error": ...}
+
+def encode(message) -> bytes:
+    # Records may hold values json doesn't know (e.g. numpy scalars)
+    return json.dumps(message, default=str).encode("utf-8") + b"\n"
+
+class ConnectionPool:
+    """Persistent connections to the node servers, at most size per peer.
+    A connection carries one request at a time and goes back to its
+    peer's idle queue afterwards."""
+
+    def __init__(self, size: int = 4) -> None:
+        self.size = size
+        # address -> asyncio.Queue of idle (reader, writer) pairs
+        self.idle = {}
+        # address -> connections opened to that peer
+        self.opened = {}
+        self.stats = {"requests": 0, "connections": 0}
+
+    async def call(self, address: tuple, method: str, *args):
+        """Calls method on the node server at address and returns its result."""
+
+        queue = self.idle.get(address)
+        if queue is None:
+            queue = self.idle[address] = asyncio.Queue()
+        if queue.empty() and self.opened.get(address, 0) < self.size:
+            self.opened[address] = self.opened.get(address, 0) + 1
+            self.stats["connections"] += 1
+            try:
+                reader, writer = await asyncio.open_connection(*address)
+            except OSError:
+                self.opened[address] -= 1
+                raise
+        else:
+            reader, writer = await queue.get()
+
+        try:
+            writer.write(encode([method, args]))
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError(f"Connection to {address} closed.")
+        except (OSError, ConnectionError):
+            # Broken connections are dropped instead of going back to the pool
+            writer.close()
+            self.opened[address] -= 1
+            raise
+        queue.put_nowait((reader, writer))
+        self.stats["requests"] += 1
+
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"{method} failed on {address}: {response['error']}")
+        return response["result"]
+
+    async def close(self) -> None:
+        """Closes all idle connections."""
+
+        writers = []
+        for queue in self.idle.values():
+            while not queue.empty():
+                writers.append(queue.get_nowait()[1])
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self.idle, self.opened = {}, {}
+
+class NodeServer:
+    """Serves one Node over TCP. Routing state stays in the Node,
+    the server answers one lookup step at a time with the ids and
+    addresses of the next nodes, so the caller does the hops."""
+
+    def __init__(self, node: Node, addresses: dict) -> None:
+        self.node = node
+        # Shared node id -> (host, port) directory
+        self.addresses = addresses
+        self.server = None
+        self.address = None
+
+    async def start(self, host: str = "127.0.0.1") -> tuple:
+        self.server = await asyncio.start_server(self.handle, host, 0)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        self.addresses[self.node.id] = self.address
+        return self.address
+
+    async def stop(self) -> None:
+        self.addresses.pop(self.node.id, None)
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                method, args = json.loads(line)
+                try:
+                    response = {"result": getattr(self, "rpc_" + method)(*args)}
+                except Exception as e:
+                    response = {"error": repr(e)}
+                writer.write(encode(response))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def reference(self, node: Node) -> list:
+        """[id, host, port] of a node, as sent over the wire."""
+
+        return [node.id, *self.addresses[node.id]]
+
+    def rpc_ping(self) -> int:
+        return self.node.id
+
+    def rpc_successor(self) -> list:
+        return self.reference(self.node.get_first_alive_succ())
+
+    def rpc_find_step(self, key: int) -> list:
+        """One step of an iterative lookup. Returns [True, successor] if
+        key ∈ (self, successor], otherwise [False, closest preceding
+        finger], the node the caller should ask next."""
+
+        node = self.node
+        succ = node.get_first_alive_succ()
+        comp_cw_dist = node.ring.comp_cw_dist
+        if node.id == key:
+            return [True, self.reference(node)]
+        if succ is node or comp_cw_dist(node.id, key, succ.id):
+            return [True, self.reference(succ)]
+        # Furthest alive finger ∈ (self, key)
+        for finger in reversed(node.fingers):
+            if finger.alive and finger.id != key and comp_cw_dist(node.id, finger.id, key):
+                return [False, self.reference(finger)]
+        return [False, self.reference(succ)]
+
+    def rpc_get(self, key: str):
+        return self.node.read(key)
+
+    def rpc_put(self, key: str, value, pos: int = None) -> None:
+        self.node.insert_item_to_node((key, value), pos=pos)
+
+    def rpc_update(self, key: str, value, pos: int = None) -> bool:
+        if key not in self.node.items:
+            return False
+        self.node.insert_item_to_node((key, value), pos=pos)
+        return True
+
+    def rpc_delete(self, key: str) -> bool:
+        if key not in self.node.items:
+            return False
+        self.node.delete_item_from_node(key)
+        return True
+
+class AsyncInterface:
+    """Networked mode of an Interface. Every node runs an asyncio server
+    on localhost and lookups are iterative: the client asks one node per
+    hop for the next one, over pooled persistent connections. Membership
+    changes still go through the wrapped Interface."""
+
+    def __init__(self, interface: Interface, host: str = "127.0.0.1",
+                 pool_size: int = 4, concurrency: int = 1000) -> None:
+        self.interface = interface
+        self.ring = interface.ring
+        self.host = host
+        # node id -> (host, port)
+        self.addresses = {}
+        self.servers = {}
+        self.pool = ConnectionPool(pool_size)
+        # Lookups in flight at once in the *_many operations
+        self.concurrency = concurrency
+
+    async def start(self) -> None:
+        """Starts a server for every node that doesn't have one."""
+
+        for node_id in self.interface.sorted_ids:
+            if node_id not in self.servers:
+                await self.serve(node_id)
+
+    async def serve(self, node_id: int) -> None:
+        server = NodeServer(self.interface.nodes[node_id], self.addresses)
+        await server.start(self.host)
+        self.servers[node_id] = server
+
+    async def close(self) -> None:
+        await self.pool.close()
+        for server in self.servers.values():
+            await server.stop()
+        self.servers = {}
+
+    async def __aenter__(self) -> 'AsyncInterface':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def find_successor(self, key: int, start_node_id: int = None) -> tuple[int, tuple, int]:
+        """Iterative lookup of key. Returns the responsible node's id and
+        address and the number of RPCs the lookup took."""
+
+        node_id = self.interface.get_node(start_node_id).id
+        address = self.addresses[node_id]
+        hops = 0
+        while True:
+            done, (node_id, host, port) = await self.pool.call(address, "find_step", key)
+            hops += 1
+            address = (host, port)
+            if done:
+                return node_id, address, hops
+
+    async def find_successor_many(self, keys: list[int], start_node_id: int = None) -> list[tuple]:
+        """Runs the lookups of keys concurrently, at most self.concurrency
+        at a time. Returns their results in the order of keys."""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(key):
+            async with semaphore:
+                return await self.find_successor(key, start_node_id)
+
+        return await asyncio.gather(*(bounded(key) for key in keys))
+
+    async def insert_item(self, new_item: tuple, start_node_id: int = None) -> None:
+        """Inserts an item (key, value) to the correct node of the network."""
+
+        pos = self.ring.hash_func(new_item[0])
+        _, address, _ = await self.find_successor(pos, start_node_id)
+        await self.pool.call(address, "put", new_item[0], new_item[1], pos)
+
+    async def get_item(self, key: str, start_node_id: int = None):
+        """Returns the record (value) of an item given its key, or None."""
+
+        _, address, _ = await self.find_successor(self.ring.hash_func(key), start_node_id)
+        return await self.pool.call(address, "get", key)
+
+    async def update_record(self, new_item: tuple, start_node_id: int = None) -> None:
+        """Updates the record (value) of an item given its key."""
+
+        pos = self.ring.hash_func(new_item[0])
+        _, address, _ = await self.find_successor(pos, start_node_id)
+        if not await self.pool.call(address, "update", new_item[0], new_item[1], pos):
+            print(f"Could not find item with key {new_item[0]}")
+
+    async def delete_item(self, key: str, start_node_id: int = None) -> None:
+        """Finds node responsible for key and removes the (key, value) entry from it."""
+
+        _, address, _ = await self.find_successor(self.ring.hash_func(key), start_node_id)
+        if not await self.pool.call(address, "delete", key):
+            print(f"Key {key} not found")
+
+    async def insert_items(self, new_items: list[tuple], start_node_id: int = None) -> None:
+        """Inserts many items (key, value) concurrently."""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(item):
+            async with semaphore:
+                await self.insert_item(item, start_node_id)
+
+        await asyncio.gather(*(bounded(item) for item in new_items))
+
+    async def get_items(self, keys: list[str], start_node_id: int = None) -> list:
+        """Returns the records of many keys, fetched concurrently."""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(key):
+            async with semaphore:
+                return await self.get_item(key, start_node_id)
+
+        return await asyncio.gather(*(bounded(key) for key in keys))
+
+    async def node_join(self, new_node_id: int, start_node_id: int = None) -> None:
+        """Adds node to the network and starts its server."""
+
+        self.interface.node_join(new_node_id, start_node_id)
+        if new_node_id in self.interface.nodes and new_node_id not in self.servers:
+            await self.serve(new_node_id)
+
+    async def node_leave(self, node_id: int, start_node_id: int = None) -> None:
+        """Removes node from the network and stops its server."""
+
+        self.interface.node_leave(node_id, start_node_id)
+        if node_id not in self.interface.nodes and node_id in self.servers:
+            await self.servers.pop(node_id).stop()
+
+async def benchmark(node_count: int = 100, lookups: int = 10_000, concurrency: int = 1000,
+                    pool_size: int = 4, ks: int = 32) -> dict:
+    """Throughput of concurrent lookups over RPC, next to the same
+    lookups routed in process."""
+
+    interface = Interface(RingConfig(ks=ks))
+    interface.build_network(node_count, bulk=True)
+    keys = [random.randrange(interface.ring.hs) for _ in range(lookups)]
+
+    start = perf_counter()
+    expected = [interface.get_node().find_successor(key).id for key in keys]
+    local_seconds = perf_counter() - start
+
+    async with AsyncInterface(interface, pool_size=pool_size, concurrency=concurrency) as network:
+        start = perf_counter()
+        results = await network.find_successor_many(keys)
+        rpc_seconds = perf_counter() - start
+        stats = dict(network.pool.stats)
+
+    return {
+        "nodes": node_count,
+        "lookups": lookups,
+        "concurrency": concurrency,
+        "correct": sum(result[0] == node_id for result, node_id in zip(results, expected)) / lookups,
+        "mean_hops": sum(result[2] for result in results) / lookups,
+        "rpc_lookups_per_sec": lookups / rpc_seconds,
+        "local_lookups_per_sec": lookups / local_seconds,
+        "requests": stats["requests"],
+        "connections": stats["connections"],
+    }
+
+if __name__ == "__main__":
+    print(asyncio.run(benchmark()))
@@ -0,0 +1,345 @@
+from node import Node, build_tables
+from config import RingConfig
+from bisect import bisect_left, bisect_right
+from time import perf_counter
+import multiprocessing as mp
+import queue
+import random
+import os
+
+# A task is [request, op, key, node_id, hops, payload, resolved, error].
+# Tasks travel between processes in batches (lists), one message per
+# destination. error is set, and the task sent back, if a worker raised.
+REQUEST, OP, KEY, NODE, HOPS, PAYLOAD, RESOLVED, ERROR = range(8)
+# Seconds between liveness checks of the workers while waiting for results
+POLL = 1.0
+
+class Shard:
+    """Nodes of one contiguous arc of the ring, owned by a worker process.
+    Fingers that point outside the arc are stub Nodes (no finger table),
+    a lookup that reaches one is forwarded to the stub's shard."""
+
+    def __init__(self, index: int, ring: RingConfig, ids: list[int], firsts: list[int]) -> None:
+        self.index = index
+        self.ring = ring
+        # First node id of every shard, to find who owns a node id
+        self.firsts = firsts
+        first, last = firsts[index], (firsts[index + 1] if index + 1 < len(firsts) else ring.hs)
+        lo, hi = bisect_left(ids, first), bisect_left(ids, last)
+        count = len(ids)
+        self.nodes = {node_id: Node(node_id, ring) for node_id in ids[lo:hi]}
+        stubs = {}
+
+        # The arc's nodes, and stubs for the nodes outside it
+        def node_at(j: int) -> Node:
+            node_id = ids[j % count]
+            node = self.nodes.get(node_id)
+            if node is None:
+                node = stubs.get(node_id)
+                if node is None:
+                    node = stubs[node_id] = Node(node_id, ring)
+            return node
+
+        build_tables(ring, ids, range(lo, hi), node_at)
+
+    def owner(self, node_id: int) -> int:
+        """Index of the shard that owns node_id."""
+
+        return bisect_right(self.firsts, node_id) - 1
+
+    def process(self, task: list) -> int | None:
+        """Advances a task as far as this shard can. Returns the shard
+        to forward it to, or None once task holds the result."""
+
+        ks = self.ring.ks
+        comp_cw_dist = self.ring.comp_cw_dist
+        key = task[KEY]
+        current = self.nodes[task[NODE]]
+        if task[RESOLVED]:
+            return self.apply(task, current)
+
+        hops = task[HOPS]
+        # Node.route's walk, stopping at the first stub
+        while True:
+            start = current
+            for i in range(ks):
+                finger = current.fingers[i]
+                if comp_cw_dist(current.id, finger.id, key):
+                    current = finger
+                    hops += 1
+                    # Stubs have no finger table, their shard goes on
+                    if not finger.fingers:
+                        task[NODE], task[HOPS] = finger.id, hops
+                        return self.owner(finger.id)
+            if current is start:
+                break
+
+        task[HOPS] = hops
+        if current.id != key:
+            current = current.fingers[0]
+            task[HOPS] += 1
+        task[NODE], task[RESOLVED] = current.id, True
+        if current.id in self.nodes:
+            return self.apply(task, current)
+        return self.owner(current.id)
+
+    def apply(self, task: list, node: Node) -> None:
+        """Runs the task's operation on the responsible node.
+        The result replaces the payload."""
+
+        op, payload = task[OP], task[PAYLOAD]
+        items = node.items
+        if op == "put":
+            items.put(payload[0], payload[1], task[KEY])
+            task[PAYLOAD] = None
+        elif op == "update":
+            found = payload[0] in items
+            if found:
+                items.put(payload[0], payload[1], task[KEY])
+            task[PAYLOAD] = found
+        elif op == "get":
+            task[PAYLOAD] = items[payload] if payload in items else None
+        elif op == "delete":
+            found = payload in items
+            if found:
+                items.remove(payload)
+            task[PAYLOAD] = found
+        elif op == "count":
+            task[PAYLOAD] = len(items)
+        return None
+
+def worker(index: int, ring: RingConfig, ids: list[int], firsts: list[int], inboxes: list, results) -> None:
+    """Worker process loop. Every message is a batch of tasks, the
+    tasks that leave the shard are forwarded in one batch per shard."""
+
+    shard = Shard(index, ring, ids, firsts)
+    inbox = inboxes[index]
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            return
+        done = []
+        forward = {}
+        pending = batch
+        while pending:
+            local = []
+            for task in pending:
+                try:
+                    destination = shard.process(task)
+                except Exception as error:
+                    # A bad task must not kill the worker, the coordinator would wait forever
+                    task[ERROR] = f"{type(error).__name__}: {error}"
+                    destination = None
+                if destination is None:
+                    done.append(task)
+                elif destination == index:
+                    local.append(task)
+                else:
+                    forward.setdefault(destination, []).append(task)
+            pending = local
+        for destination, tasks in forward.items():
+            inboxes[destination].put(tasks)
+        if done:
+            results.put(done)
+
+class ShardedInterface:
+    """Interface-like coordinator of a ring partitioned into contiguous
+    arcs, one per worker process, so lookups use all cores. Operations
+    are sent to workers in batches and cross-shard hops are forwarded
+    between workers over queues. Membership is fixed once built."""
+
+    def __init__(self, ring: RingConfig = None, workers: int = None, batch_size: int = 1024) -> None:
+        self.ring = ring if ring is not None else RingConfig()
+        self.workers = workers or os.cpu_count()
+        # Tasks per message from the coordinator
+        self.batch_size = batch_size
+        self.sorted_ids = []
+        self.firsts = []
+        self.processes = []
+        self.inboxes = []
+        self.results = None
+        self.next_request = 0
+
+    def __enter__(self) -> 'ShardedInterface':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def build_network(self, node_count: int, node_ids: list = []) -> None:
+        """Creates the nodes and starts one worker per arc.
+        Every worker builds the tables of its own nodes."""
+
+        if self.processes:
+            raise RuntimeError("Sharded network is already built.")
+        if node_ids == []:
+            final_ids = self.ring.random_ids(node_count)
+        else:
+            final_ids = {node_id for node_id in node_ids if 0 <= node_id < self.ring.hs}
+        ids = sorted(final_ids)
+        if not ids:
+            return
+
+        workers = min(self.workers, len(ids))
+        self.sorted_ids = ids
+        self.firsts = [ids[len(ids) * i // workers] for i in range(workers)]
+        self.inboxes = [mp.Queue() for _ in range(workers)]
+        self.results = mp.Queue()
+        for index in range(workers):
+            process = mp.Process(target=worker, daemon=True,
+                                 args=(index, self.ring, ids, self.firsts, self.inboxes, self.results))
+            process.start()
+            self.processes.append(process)
+
+    def close(self) -> None:
+        """Stops the workers."""
+
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes, self.inboxes = [], []
+
+    def owner(self, node_id: int) -> int:
+        return bisect_right(self.firsts, node_id) - 1
+
+    def run(self, tasks: list[tuple], start_node_id: int = None) -> list[list]:
+        """Runs (op, key, payload) tasks and returns them finished, in order.
+        Each task starts from start_node_id, or from a random node so
+        the entry points are spread over the shards."""
+
+        ids = self.sorted_ids
+        if start_node_id is not None:
+            i = bisect_left(ids, start_node_id)
+            if i == len(ids) or ids[i] != start_node_id:
+                raise ValueError(f"Node with id {start_node_id} not found.")
+        outgoing = {}
+        for op, key, payload in tasks:
+            start = start_node_id if start_node_id is not None else ids[random.randrange(len(ids))]
+            task = [self.next_request, op, key, start, 0, payload, False, None]
+            self.next_request += 1
+            batch = outgoing.setdefault(self.owner(start), [])
+            batch.append(task)
+            if len(batch) == self.batch_size:
+                self.inboxes[self.owner(start)].put(batch)
+                outgoing[self.owner(start)] = []
+        for index, batch in outgoing.items():
+            if batch:
+                self.inboxes[index].put(batch)
+
+        first = self.next_request - len(tasks)
+        finished = [None] * len(tasks)
+        remaining = len(tasks)
+        while remaining:
+            try:
+                batch = self.results.get(timeout=POLL)
+            except queue.Empty:
+                dead = [index for index, process in enumerate(self.processes) if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Shard workers {dead} exited, their tasks are lost.")
+                continue
+            for task in batch:
+                finished[task[REQUEST] - first] = task
+                remaining -= 1
+        errors = [task for task in finished if task[ERROR] is not None]
+        if errors:
+            raise RuntimeError(f"{len(errors)} tasks failed in the shard workers, "
+                               f"e.g. {errors[0][OP]} {errors[0][KEY]}: {errors[0][ERROR]}")
+        return finished
+
+    def route_many(self, keys: list[int], start_node_id: int = None) -> list[tuple[int, int]]:
+        """(responsible node id, hops) of every key."""
+
+        return [(task[NODE], task[HOPS]) for task in self.run([("find", key, None) for key in keys], start_node_id)]
+
+    def find_successor(self, key: int, start_node_id: int = None) -> int:
+        """Id of the node responsible for key."""
+
+        return self.run([("find", key, None)], start_node_id)[0][NODE]
+
+    def find_successor_many(self, keys: list[int], start_node_id: int = None) -> dict:
+        """Returns a {key: responsible node id} mapping."""
+
+        keys = list(keys)
+        return dict(zip(keys, (node_id for node_id, _ in self.route_many(keys, start_node_id))))
+
+    def insert_item(self, new_item: tuple, start_node_id: int = None) -> None:
+        """Inserts an item (key, value) to the correct node of the network."""
+
+        self.insert_items([new_item], start_node_id)
+
+    def insert_items(self, new_items: list[tuple], start_node_id: int = None) -> None:
+        hash_func = self.ring.hash_func
+        self.run([("put", hash_func(item[0]), item) for item in new_items], start_node_id)
+
+    def update_record(self, new_item: tuple, start_node_id: int = None) -> None:
+        """Updates the record (value) of an item given its key."""
+
+        self.update_records([new_item], start_node_id)
+
+    def update_records(self, new_items: list[tuple], start_node_id: int = None) -> None:
+        hash_func = self.ring.hash_func
+        new_items = list(new_items)
+        tasks = self.run([("update", hash_func(item[0]), item) for item in new_items], start_node_id)
+        for item, task in zip(new_items, tasks):
+            if not task[PAYLOAD]:
+                print(f"Could not find item with key {item[0]}")
+
+    def get_item(self, key: str, start_node_id: int = None):
+        """Returns the record (value) of an item given its key, or None."""
+
+        return self.get_items([key], start_node_id)[0]
+
+    def get_items(self, keys: list[str], start_node_id: int = None) -> list:
+        hash_func = self.ring.hash_func
+        return [task[PAYLOAD] for task in self.run([("get", hash_func(key), key) for key in keys], start_node_id)]
+
+    def delete_item(self, key: str, start_node_id: int = None) -> None:
+        """Finds node responsible for key and removes the (key, value) entry from it."""
+
+        self.delete_items([key], start_node_id)
+
+    def delete_items(self, keys: list[str], start_node_id: int = None) -> None:
+        hash_func = self.ring.hash_func
+        keys = list(keys)
+        tasks = self.run([("delete", hash_func(key), key) for key in keys], start_node_id)
+        for key, task in zip(keys, tasks):
+            if not task[PAYLOAD]:
+                print(f"Key {key} not found")
+
+    def item_count(self) -> int:
+        """Number of items stored in the network."""
+
+        return sum(task[PAYLOAD] for task in self.run([("count", node_id, None) for node_id in self.sorted_ids]))
+
+def benchmark(node_count: int = 100_000, lookups: int = 200_000, ks: int = 32) -> list[dict]:
+    """Lookup throughput for 1, 2, 4, ... workers up to the core count."""
+
+    keys = [random.randrange(1 << ks) for _ in range(lookups)]
+    node_ids = random.sample(range(1 << ks), node_count)
+    counts = []
+    workers = 1
+    while workers < (os.cpu_count() or 1):
+        counts.append(workers)
+        workers *= 2
+    counts.append(os.cpu_count() or 1)
+
+    results = []
+    for workers in counts:
+        with ShardedInterface(RingConfig(ks=ks), workers=workers) as network:
+            network.build_network(node_count, node_ids)
+            # Wait for the workers to build their shards
+            network.route_many(keys[:workers])
+            start = perf_counter()
+            routes = network.route_many(keys)
+            seconds = perf_counter() - start
+        results.append({
+            "workers": workers,
+            "lookups_per_sec": lookups / seconds,
+            "mean_hops": sum(hops for _, hops in routes) / lookups,
+        })
+        print(results[-1])
+    return results
+
+if __name__ == "__main__":
+    benchmark()
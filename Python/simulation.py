@@ -0,0 +1,211 @@
+from interface import Interface
+from config import RingConfig
+from stats import percentile
+from time import perf_counter
+import heapq
+import random
+
+class Simulator:
+    """Discrete-event simulation of a Chord network.
+    Events wait in a priority queue ordered by virtual time, so periodic
+    per-node maintenance, churn and client lookups interleave like they
+    would in a deployment, without waiting in wall-clock time."""
+
+    def __init__(self, interface: Interface, stabilize_interval: float = 30.0,
+                 fix_finger_interval: float = 10.0, hop_latency: float = 0.05, seed: int = None) -> None:
+        self.interface = interface
+        # Virtual seconds between two maintenance calls of a node
+        self.stabilize_interval = stabilize_interval
+        self.fix_finger_interval = fix_finger_interval
+        # Virtual seconds per routing hop
+        self.hop_latency = hop_latency
+        self.random = random.Random(seed)
+        # Virtual clock (seconds)
+        self.now = 0.0
+        # Heap of (time, sequence, callback, args), sequence breaks ties
+        self.events = []
+        self.sequence = 0
+        self.processed = 0
+        # Next finger table entry each node refreshes
+        self.next_finger = {}
+        self.lookups = {"total": 0, "correct": 0, "failed": 0}
+        self.latencies = []
+        self.timeline = []
+        for node_id in interface.sorted_ids:
+            self.start_maintenance(interface.nodes[node_id])
+
+    def schedule(self, delay: float, callback, *args) -> None:
+        """Runs callback(*args) delay virtual seconds from now."""
+
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, callback, args))
+
+    def run(self, until: float) -> dict:
+        """Processes events up to virtual time until. Returns the report."""
+
+        wall_start = perf_counter()
+        while self.events and self.events[0][0] <= until:
+            time, _, callback, args = heapq.heappop(self.events)
+            self.now = time
+            callback(*args)
+            self.processed += 1
+        self.now = until
+        return self.report(perf_counter() - wall_start)
+
+    def start_maintenance(self, node) -> None:
+        """Schedules a node's periodic stabilize and fix_finger,
+        with random phases so nodes don't run in lockstep."""
+
+        self.next_finger[node.id] = 1
+        self.schedule(self.random.uniform(0, self.stabilize_interval), self.stabilize, node)
+        self.schedule(self.random.uniform(0, self.fix_finger_interval), self.fix_finger, node)
+
+    def in_network(self, node) -> bool:
+        """False once the node has left or failed."""
+
+        return node.alive and self.interface.nodes.get(node.id) is node
+
+    def stabilize(self, node) -> None:
+        if not self.in_network(node):
+            return
+        node.stabilize()
+        self.schedule(self.stabilize_interval * self.random.uniform(0.5, 1.5), self.stabilize, node)
+
+    def fix_finger(self, node) -> None:
+        """Refreshes one finger per call, cycling through the table.
+        Entry 0 is the successor, kept by stabilize."""
+
+        if not self.in_network(node):
+            return
+        i = self.next_finger[node.id]
+        node.fix_finger(i)
+        self.next_finger[node.id] = i + 1 if i + 1 < self.interface.ring.ks else 1
+        self.schedule(self.fix_finger_interval * self.random.uniform(0.5, 1.5), self.fix_finger, node)
+
+    def add_churn(self, join_rate: float = 0.0, leave_rate: float = 0.0, fail_rate: float = 0.0) -> None:
+        """Starts Poisson join, leave and failure processes (events per virtual second)."""
+
+        for rate, event in ((join_rate, self.join), (leave_rate, self.leave), (fail_rate, self.fail)):
+            if rate > 0:
+                self.schedule(self.random.expovariate(rate), self.poisson, rate, event)
+
+    def add_lookups(self, rate: float) -> None:
+        """Starts a Poisson process of client lookups (per virtual second)."""
+
+        if rate > 0:
+            self.schedule(self.random.expovariate(rate), self.poisson, rate, self.lookup)
+
+    def add_sampling(self, interval: float) -> None:
+        """Records a consistency sample every interval virtual seconds."""
+
+        self.schedule(interval, self.sample, interval)
+
+    def load_trace(self, trace: list[tuple]) -> None:
+        """Schedules (time, event, node_id) entries, where event is
+        'join', 'leave' or 'fail', at their absolute virtual times."""
+
+        events = {"join": self.join, "leave": self.leave, "fail": self.fail}
+        for time, event, node_id in trace:
+            self.schedule(max(time - self.now, 0.0), events[event], node_id)
+
+    def poisson(self, rate: float, event) -> None:
+        event()
+        self.schedule(self.random.expovariate(rate), self.poisson, rate, event)
+
+    def join(self, node_id: int = None) -> None:
+        interface = self.interface
+        if node_id is None:
+            node_id = self.random.randrange(interface.ring.hs)
+        if node_id in interface.nodes:
+            return
+        interface.node_join(node_id, lazy=True)
+        self.start_maintenance(interface.nodes[node_id])
+
+    def leave(self, node_id: int = None) -> None:
+        interface = self.interface
+        if len(interface.sorted_ids) < 2:
+            return
+        if node_id is None:
+            node_id = self.random.choice(interface.sorted_ids)
+        node = interface.nodes.get(node_id)
+        # Nodes that haven't been integrated yet can't hand off gracefully
+        if node is None or node.pred is None:
+            return
+        interface.node_leave(node_id, start_node_id=node_id)
+
+    def fail(self, node_id: int = None) -> None:
+        interface = self.interface
+        if node_id is None:
+            node_id = self.random.choice(interface.sorted_ids)
+        interface.fail_nodes(node_ids=[node_id])
+
+    def lookup(self) -> None:
+        """Routes a random key from a random node. The latency is the
+        hop count times hop_latency."""
+
+        interface = self.interface
+        key = self.random.randrange(interface.ring.hs)
+        start = interface.nodes[self.random.choice(interface.sorted_ids)]
+        node, hops = start.route(key)
+        self.lookups["total"] += 1
+        if node is None:
+            self.lookups["failed"] += 1
+            return
+        if node.id == interface.successor_id(key):
+            self.lookups["correct"] += 1
+        self.latencies.append(hops * self.hop_latency)
+
+    def sample(self, interval: float) -> None:
+        """Fraction of nodes with the right successor, and the lookup
+        success rate since the previous sample."""
+
+        interface = self.interface
+        ring = interface.ring
+        correct = sum(interface.nodes[node_id].fingers[0].id == interface.successor_id((node_id + 1) & ring.mask)
+                      for node_id in interface.sorted_ids)
+        previous = self.timeline[-1] if self.timeline else {"lookups": 0, "correct": 0}
+        window = self.lookups["total"] - previous["lookups"]
+        self.timeline.append({
+            "time": self.now,
+            "nodes": len(interface.sorted_ids),
+            "succ_correct": correct / len(interface.sorted_ids),
+            "lookup_success": (self.lookups["correct"] - previous["correct"]) / window if window else None,
+            "lookups": self.lookups["total"],
+            "correct": self.lookups["correct"],
+        })
+        self.schedule(interval, self.sample, interval)
+
+    def report(self, wall_seconds: float = None) -> dict:
+        """Lookup success and latency over the whole run, and the timeline."""
+
+        latencies = sorted(self.latencies)
+        return {
+            "virtual_time": self.now,
+            "wall_seconds": wall_seconds,
+            "events": self.processed,
+            "nodes": len(self.interface.sorted_ids),
+            "lookups": dict(self.lookups),
+            "success_rate": self.lookups["correct"] / self.lookups["total"] if self.lookups["total"] else None,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_p99": percentile(latencies, 99),
+            "timeline": self.timeline,
+        }
+
+def main():
+    # One virtual hour of a 1000 node ring with churn and lookups
+    interface = Interface(RingConfig(ks=32))
+    interface.build_network(1000, bulk=True)
+    simulator = Simulator(interface, seed=0)
+    simulator.add_churn(join_rate=0.01, leave_rate=0.01, fail_rate=0.005)
+    simulator.add_lookups(1.0)
+    simulator.add_sampling(600)
+
+    report = simulator.run(3600)
+    for sample in report.pop("timeline"):
+        print(sample)
+    print(report)
+
+if __name__ == "__main__":
+    main()
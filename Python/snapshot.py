@@ -0,0 +1,286 @@
+from interface import Interface
+from config import RingConfig
+from node import Node
+from store import ItemStore
+from columns import ColumnarItemStore
+from array import array
+from functools import partial
+from time import perf_counter
+import numpy as np
+import gc
+import mmap
+import pickle
+import random
+import struct
+import sys
+
+# File layout, all integers little-endian:
+#   header           magic, ks, sls, replicas, node count, settings length
+#   settings         pickled {"key_encoder": name or None, "schema", "indexes"}
+#   node ids         node_count * width bytes, in Interface.nodes order
+#   owners           node_count * width bytes, physical node id of each node
+#   predecessors     node_count * u32 node index
+#   fingers          node_count * ks * u32 node index
+#   successor lists  node_count * sls * u32 node index, NONE padded
+#   item index       (node_count + 1) * u64 segment offset, node_count * u32 item count
+#   item segments    per node: positions (count * width bytes), pickled (keys, values)
+MAGIC = b"CHORDSS3"
+HEADER = struct.Struct("<8sHHHQQ")
+NONE = 0xFFFFFFFF
+
+def width(ks: int) -> int:
+    """Bytes per id or position, 8 when they fit a u64."""
+
+    return 8 if ks <= 64 else 20
+
+def encode_ints(values: list[int], size: int) -> bytes:
+    if size == 8:
+        data = array("Q", values)
+        if sys.byteorder == "big":
+            data.byteswap()
+        return data.tobytes()
+    return b"".join(value.to_bytes(size, "little") for value in values)
+
+def decode_ints(data, size: int) -> list[int]:
+    if size == 8:
+        values = array("Q")
+        values.frombytes(data)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values.tolist()
+    return [int.from_bytes(data[i:i + size], "little") for i in range(0, len(data), size)]
+
+def encode_indices(values: list[int]) -> bytes:
+    data = array("I", values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+def decode_indices(data) -> array:
+    values = array("I")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def lazy_store(base: type) -> type:
+    """Subclass of an item store class whose items are filled in the
+    first time the store is used, by calling source(store)."""
+
+    class LazyStore(base):
+        __slots__ = ("source",)
+
+        def __init__(self, ring: RingConfig, source) -> None:
+            self.ring = ring
+            self.source = source
+
+        def __getattr__(self, name: str):
+            # Only called while the slots are still unset
+            if name == "source" or self.source is None:
+                raise AttributeError(name)
+            self.fill()
+            return getattr(self, name)
+
+        def fill(self) -> None:
+            source, self.source = self.source, None
+            base.__init__(self, self.ring)
+            source(self)
+
+    LazyStore.__name__ = LazyStore.__qualname__ = f"Lazy{base.__name__}"
+    return LazyStore
+
+# Stores backed by a node's segment of a snapshot file, or by its
+# predecessors' items for replicas
+LazyItemStore = lazy_store(ItemStore)
+LazyColumnarItemStore = lazy_store(ColumnarItemStore)
+
+def fill_segment(data, offset: int, count: int, length: int, store: ItemStore) -> None:
+    """Decodes a node's item segment into store."""
+
+    size = width(store.ring.ks)
+    split = offset + count * size
+    positions = decode_ints(data[offset:split], size)
+    keys, values = pickle.loads(data[split:offset + length])
+    if isinstance(store, ColumnarItemStore):
+        store.put_sorted(keys, values, positions)
+        return
+    store.positions = positions
+    store.keys_list = keys
+    store.entries = {key: (pos, value) for key, pos, value in zip(keys, positions, values)}
+
+def fill_replicas(preds: list[Node], store: ItemStore) -> None:
+    """Copies the items of preds into store, as Node.refresh_replicas.
+    preds are taken when the snapshot is loaded, so a predecessor that
+    fails before the replicas are first used still gets promoted."""
+
+    for pred in preds:
+        store.merge(pred.items.copy())
+
+def encoder_name(ring: RingConfig) -> str | None:
+    encoder = ring.key_encoder
+    if encoder is None:
+        return None
+    return f"{getattr(encoder, '__module__', '')}.{getattr(encoder, '__qualname__', repr(encoder))}"
+
+def save(interface: Interface, filename: str) -> int:
+    """Writes the network and its items to filename.
+    Every pointer must point to a node of the network, so failed
+    nodes must be healed first. Returns the file size in bytes."""
+
+    ring = interface.ring
+    size = width(ring.ks)
+    nodes = list(interface.nodes.values())
+    index = {node.id: i for i, node in enumerate(nodes)}
+
+    def indices(refs: list[Node]) -> list[int]:
+        try:
+            return [index[ref.id] if ref is not None else NONE for ref in refs]
+        except KeyError:
+            raise ValueError("A node points to a node outside the network, heal() the ring first.")
+
+    # key_encoder is a function, only its name is kept, load() is given the ring
+    settings = pickle.dumps({"key_encoder": encoder_name(ring), "schema": ring.schema,
+                             "indexes": dict(interface.indexes)}, pickle.HIGHEST_PROTOCOL)
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, ring.ks, ring.sls, ring.replicas, len(nodes), len(settings)))
+        f.write(settings)
+        f.write(encode_ints([node.id for node in nodes], size))
+        f.write(encode_ints([node.owner for node in nodes], size))
+        f.write(encode_indices(indices([node.pred for node in nodes])))
+        f.write(b"".join(encode_indices(indices(node.fingers)) for node in nodes))
+        f.write(b"".join(encode_indices(indices(node.succ_list + [None] * (ring.sls - len(node.succ_list))))
+                         for node in nodes))
+
+        segments = []
+        for node in nodes:
+            items = node.items
+            segments.append(encode_ints(items.positions, size)
+                            + pickle.dumps((items.keys_list, items.values()), pickle.HIGHEST_PROTOCOL))
+        start = f.tell() + (len(nodes) + 1) * 8 + len(nodes) * 4
+        offsets = [start]
+        for segment in segments:
+            offsets.append(offsets[-1] + len(segment))
+        f.write(encode_ints(offsets, 8))
+        f.write(encode_indices([len(node.items) for node in nodes]))
+        for segment in segments:
+            f.write(segment)
+        return f.tell()
+
+def load(filename: str, lazy: bool = True, ring: RingConfig = None) -> Interface:
+    """Restores a network saved with save. The file is memory-mapped
+    and, with lazy, a node's items (and replicas) are only decoded when
+    first used. A ring saved with a key_encoder must be given as ring,
+    a new RingConfig checked against the saved parameters."""
+
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, ks, sls, replicas, count, settings_length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a ring snapshot.")
+    settings = pickle.loads(data[HEADER.size:HEADER.size + settings_length])
+
+    if ring is None:
+        if settings["key_encoder"] is not None:
+            raise ValueError(f"{filename} was saved from a ring with key_encoder {settings['key_encoder']}, "
+                             f"pass ring= with the same encoder.")
+        ring = RingConfig(ks=ks, sls=sls, replicas=replicas, schema=settings["schema"])
+    elif (ring.ks, ring.sls, ring.replicas) != (ks, sls, replicas) \
+            or encoder_name(ring) != settings["key_encoder"] \
+            or (ring.schema is None) != (settings["schema"] is None):
+        raise ValueError(f"ring {ring!r} (key_encoder {encoder_name(ring)}, schema {ring.schema}) doesn't match "
+                         f"{filename}: ks={ks}, sls={sls}, replicas={replicas}, "
+                         f"key_encoder {settings['key_encoder']}, schema {settings['schema']}.")
+    # Rejects a ring that another Interface uses before any node is built
+    interface = Interface(ring)
+    size = width(ks)
+    offset = HEADER.size + settings_length
+
+    def section(length: int):
+        nonlocal offset
+        offset += length
+        return data[offset - length:offset]
+
+    ids = decode_ints(section(count * size), size)
+    owners = decode_ints(section(count * size), size)
+    # Node index sections as numpy arrays over the mapped file
+    preds = np.frombuffer(section(count * 4), dtype="<u4")
+    fingers = np.frombuffer(section(count * ks * 4), dtype="<u4")
+    succ_lists = np.frombuffer(section(count * sls * 4), dtype="<u4")
+    offsets = decode_ints(section((count + 1) * 8), 8)
+    item_counts = decode_indices(section(count * 4))
+
+    # Millions of new references, cyclic GC passes would only slow this down
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # Node() would also create an empty ItemStore per node
+        nodes = [Node.__new__(Node) for _ in range(count)]
+        # Index -> node lookup table, index count is None
+        table = np.empty(count + 1, dtype=object)
+        table[:count] = nodes
+
+        def resolve(indices: np.ndarray) -> np.ndarray:
+            return table[np.where(indices == NONE, count, indices)]
+
+        pred_nodes = resolve(preds).tolist()
+        finger_rows = resolve(fingers).reshape(count, ks).tolist()
+        succ_rows = resolve(succ_lists).reshape(count, sls).tolist()
+        padded = bool((succ_lists == NONE).any())
+        store = LazyColumnarItemStore if ring.schema is not None else LazyItemStore
+        for i, node in enumerate(nodes):
+            node.id = ids[i]
+            node.ring = ring
+            node.alive = True
+            node.replicas = None
+            node.reads = 0
+            node.owner = owners[i]
+            node.pred = pred_nodes[i]
+            node.fingers = finger_rows[i]
+            node.succ_list = [succ for succ in succ_rows[i] if succ is not None] if padded else succ_rows[i]
+            node.items = store(ring, partial(fill_segment, data, offsets[i], item_counts[i],
+                                             offsets[i + 1] - offsets[i]))
+            if not lazy:
+                node.items.fill()
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    # Replicas aren't stored, they're copies of the predecessors' items,
+    # made on first use so a lazy load doesn't decode every node
+    if replicas:
+        for node in nodes:
+            preds = []
+            pred = node.pred
+            while len(preds) < replicas and pred is not None and pred is not node:
+                preds.append(pred)
+                pred = pred.pred
+            node.replicas = store(ring, partial(fill_replicas, preds))
+            if not lazy:
+                node.replicas.fill()
+
+    interface.indexes = dict(settings["indexes"])
+    interface.nodes = {node.id: node for node in nodes}
+    interface.sorted_ids = sorted(ids)
+    interface.epoch += 1
+    return interface
+
+def main(node_count: int = 100_000, item_count: int = 2_000_000, filename: str = "ring.snapshot") -> None:
+    # Build once, then restart from the snapshot
+    start = perf_counter()
+    interface = Interface(RingConfig(ks=32))
+    interface.build_network(node_count, bulk=True)
+    interface.bulk_load([f"key {i}" for i in range(item_count)], [random.random() for _ in range(item_count)])
+    print(f"Built {node_count} nodes with {item_count} items in {perf_counter() - start:.2f}s")
+
+    start = perf_counter()
+    file_size = save(interface, filename)
+    print(f"Saved {file_size / 2**20:.1f} MiB in {perf_counter() - start:.2f}s")
+
+    start = perf_counter()
+    restored = load(filename)
+    print(f"Loaded in {perf_counter() - start:.2f}s")
+    print(f"Consistent: {restored.check_ring()}, "
+          f"same item: {restored.get_item('key 42') == interface.get_item('key 42')}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+from functools import wraps
+from time import perf_counter
+import json
+
+def percentile(sorted_values: list, q: float) -> float:
+    """q-th percentile (0-100) of an already sorted list."""
+
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * q / 100), len(sorted_values) - 1)
+    return sorted_values[index]
+
+class Stats:
+    """Opt-in instrumentation shared by the nodes of a ring through
+    RingConfig.stats. Counters, integer histograms (hops, items moved,
+    fingers repaired) and per-operation latencies."""
+
+    def __init__(self) -> None:
+        self.counters = {}
+        # name -> {value: occurrences}
+        self.histograms = {}
+        # operation -> latencies (seconds)
+        self.latencies = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: int) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {}
+        histogram[value] = histogram.get(value, 0) + 1
+
+    def time(self, operation: str, seconds: float) -> None:
+        latencies = self.latencies.get(operation)
+        if latencies is None:
+            latencies = self.latencies[operation] = []
+        latencies.append(seconds)
+
+    def reset(self) -> None:
+        self.counters, self.histograms, self.latencies = {}, {}, {}
+
+    def summary(self) -> dict:
+        """Counters, histograms with their mean and max, and latency
+        percentiles (milliseconds) of every operation."""
+
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            total = sum(histogram.values())
+            histograms[name] = {
+                "count": total,
+                "mean": sum(value * n for value, n in histogram.items()) / total,
+                "max": max(histogram),
+                "counts": {str(value): histogram[value] for value in sorted(histogram)},
+            }
+        latencies = {}
+        for operation, values in self.latencies.items():
+            values = sorted(values)
+            latencies[operation] = {
+                "count": len(values),
+                "mean_ms": sum(values) / len(values) * 1000,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+        return {"counters": dict(self.counters), "histograms": histograms, "latencies": latencies}
+
+    def to_json(self, filename: str = None) -> str:
+        """Summary as JSON, also written to filename if given."""
+
+        text = json.dumps(self.summary(), indent=2)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(text)
+        return text
+
+def timed(operation: str):
+    """Records the latency of an Interface method when the ring's
+    stats are enabled. Disabled, it costs one attribute check."""
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            stats = self.ring.stats
+            if stats is None:
+                return method(self, *args, **kwargs)
+            start = perf_counter()
+            result = method(self, *args, **kwargs)
+            stats.time(operation, perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
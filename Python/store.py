@@ -0,0 +1,174 @@
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from config import RingConfig
+
+class ItemStore:
+    """Items of a node, kept ordered by their hashed ring position.
+    Every key is hashed once, on insertion."""
+
+    __slots__ = ("ring", "positions", "keys_list", "entries")
+
+    def __init__(self, ring: RingConfig) -> None:
+        self.ring = ring
+        # Sorted ring positions of the stored keys
+        self.positions = []
+        # Keys, parallel to positions
+        self.keys_list = []
+        # key -> (position, value)
+        self.entries = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __getitem__(self, key: str):
+        return self.entries[key][1]
+
+    def __setitem__(self, key: str, value) -> None:
+        self.put(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.remove(key)
+
+    def __iter__(self):
+        return iter(self.keys_list)
+
+    def keys(self) -> list[str]:
+        """Keys in ring order."""
+
+        return list(self.keys_list)
+
+    def values(self) -> list:
+        """Values in ring order."""
+
+        entries = self.entries
+        return [entries[key][1] for key in self.keys_list]
+
+    def items(self) -> list[tuple]:
+        """(key, value) pairs in ring order."""
+
+        entries = self.entries
+        return [(key, entries[key][1]) for key in self.keys_list]
+
+    def copy(self) -> 'ItemStore':
+        """Shallow copy, the values are shared."""
+
+        out = ItemStore(self.ring)
+        out.positions = list(self.positions)
+        out.keys_list = list(self.keys_list)
+        out.entries = dict(self.entries)
+        return out
+
+    def position(self, key: str) -> int:
+        """Cached ring position of key."""
+
+        return self.entries[key][0]
+
+    def iter_range(self, lo: int, hi: int, reverse: bool = False):
+        """Yields the (position, key, value) items with position ∈ (lo, hi]
+        in clockwise order from lo, or counter-clockwise from hi with
+        reverse. Circular like split, lo == hi is the whole ring."""
+
+        i = bisect_right(self.positions, lo)
+        j = bisect_right(self.positions, hi)
+        if lo < hi:
+            keys = self.keys_list[i:j]
+        else:
+            keys = self.keys_list[i:] + self.keys_list[:j]
+        if reverse:
+            keys.reverse()
+        entries = self.entries
+        for key in keys:
+            # Skip keys removed while the caller was consuming
+            entry = entries.get(key)
+            if entry is not None:
+                yield entry[0], key, entry[1]
+
+    def put(self, key: str, value, pos: int = None) -> None:
+        """Inserts or updates an item. pos is the hashed key,
+        if the caller already has it."""
+
+        if key in self.entries:
+            self.entries[key] = (self.entries[key][0], value)
+            return
+        if pos is None:
+            pos = self.ring.hash_func(key)
+        i = bisect_right(self.positions, pos)
+        self.positions.insert(i, pos)
+        self.keys_list.insert(i, key)
+        self.entries[key] = (pos, value)
+
+    def remove(self, key: str):
+        """Removes key and returns its value."""
+
+        pos, value = self.entries.pop(key)
+        # Keys may share a position in small rings
+        i = bisect_left(self.positions, pos)
+        while self.keys_list[i] != key:
+            i += 1
+        del self.positions[i]
+        del self.keys_list[i]
+        return value
+
+    def put_sorted(self, keys: list[str], values: list, positions: list[int]) -> None:
+        """Inserts a batch of items whose positions are already sorted."""
+
+        new = ItemStore(self.ring)
+        for key, value, pos in zip(keys, values, positions):
+            if key in self.entries:
+                self.entries[key] = (self.entries[key][0], value)
+            elif key in new.entries:
+                new.entries[key] = (pos, value)
+            else:
+                new.positions.append(pos)
+                new.keys_list.append(key)
+                new.entries[key] = (pos, value)
+        self.merge(new)
+
+    def split(self, lo: int, hi: int) -> 'ItemStore':
+        """Removes and returns the items with position ∈ (lo, hi].
+        The interval is circular, lo == hi means the whole ring."""
+
+        i = bisect_right(self.positions, lo)
+        j = bisect_right(self.positions, hi)
+        out = ItemStore(self.ring)
+        if lo < hi:
+            out.positions = self.positions[i:j]
+            out.keys_list = self.keys_list[i:j]
+            del self.positions[i:j]
+            del self.keys_list[i:j]
+        else:
+            # (lo, hs) followed by [0, hi], which sorts as [0, hi] + (lo, hs)
+            out.positions = self.positions[:j] + self.positions[i:]
+            out.keys_list = self.keys_list[:j] + self.keys_list[i:]
+            self.positions = self.positions[j:i]
+            self.keys_list = self.keys_list[j:i]
+        entries = self.entries
+        out.entries = {key: entries.pop(key) for key in out.keys_list}
+        return out
+
+    def merge(self, other: 'ItemStore') -> None:
+        """Moves all items of other into this store.
+        Keys must not already exist in this store."""
+
+        if not other.positions:
+            return
+        if not self.positions:
+            self.positions, self.keys_list = other.positions, other.keys_list
+        else:
+            i = bisect_left(self.positions, other.positions[0])
+            j = bisect_right(self.positions, other.positions[-1])
+            if i == j:
+                # other is one contiguous run, splice it in
+                self.positions[i:i] = other.positions
+                self.keys_list[i:i] = other.keys_list
+            else:
+                # Two sorted runs, which timsort merges in linear time
+                pairs = sorted(zip(self.positions + other.positions,
+                                   self.keys_list + other.keys_list), key=itemgetter(0))
+                self.positions = [pair[0] for pair in pairs]
+                self.keys_list = [pair[1] for pair in pairs]
+        self.entries.update(other.entries)
+        other.positions, other.keys_list, other.entries = [], [], {}
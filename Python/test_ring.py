@@ -0,0 +1,250 @@
+from interface import Interface, parse_csv
+from config import RingConfig, date_plot_encoder
+from columns import RecordSchema
+from concurrency import ThreadSafeInterface
+import snapshot
+import os
+import random
+import threading
+import pytest
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "NH4_NO3.csv")
+
+def ring_distance(ring: RingConfig, a: int, b: int) -> int:
+    return min(ring.cw_dist(a, b), ring.cw_dist(b, a))
+
+def tables(interface: Interface) -> dict:
+    """node id -> (predecessor, fingers, successor list) ids."""
+
+    return {node_id: (node.pred.id, [finger.id for finger in node.fingers], [succ.id for succ in node.succ_list])
+            for node_id, node in interface.nodes.items()}
+
+def network(ks: int, node_count: int, item_count: int, seed: int, **options) -> Interface:
+    random.seed(seed)
+    interface = Interface(RingConfig(ks=ks, **options))
+    interface.build_network(node_count, bulk=True)
+    interface.bulk_load([f"key {i}" for i in range(item_count)], list(range(item_count)))
+    return interface
+
+@pytest.mark.parametrize("ks", [3, 5, 8, 32, 64, 160])
+@pytest.mark.parametrize("seed", range(3))
+def test_random_joins_and_leaves(ks, seed):
+    rng = random.Random(seed)
+    random.seed(seed)
+    interface = Interface(RingConfig(ks=ks))
+    interface.build_network(2)
+    items = {f"key {i}": i for i in range(100)}
+    interface.insert_all_data(items.items())
+    assert interface.check_ring(print_errors=True)
+
+    for _ in range(60):
+        free = interface.ring.hs - len(interface.nodes)
+        if len(interface.nodes) > 1 and (not free or rng.random() < 0.4):
+            interface.node_leave(rng.choice(interface.sorted_ids))
+        else:
+            node_id = rng.randrange(interface.ring.hs)
+            while node_id in interface.nodes:
+                node_id = rng.randrange(interface.ring.hs)
+            interface.node_join(node_id, lazy=rng.random() < 0.3)
+            interface.heal()
+        assert interface.check_ring(print_errors=True)
+        assert all(interface.get_item(key) == value for key, value in items.items())
+
+@pytest.mark.parametrize("replicas", [0, 2])
+def test_leave_next_to_failed_successor(replicas):
+    interface = network(32, 50, 3000, 0, replicas=replicas)
+    failed, leaving = interface.sorted_ids[5], interface.sorted_ids[4]
+    lost = set(interface.nodes[failed].items.keys()) if not replicas else set()
+    interface.fail_nodes(node_ids=[failed])
+    interface.node_leave(leaving)
+    assert interface.heal() is not None
+    assert interface.check_ring(print_errors=True)
+    # Only the failed node's items are lost, and none with replicas
+    assert {f"key {i}" for i in range(3000) if interface.get_item(f"key {i}") != i} == lost
+
+def test_routing_from_a_node_cut_off_by_failures():
+    interface = Interface(RingConfig(ks=5))
+    interface.build_network(8, list(range(0, 32, 4)))
+    # Every successor and finger of node 0, the start node, fails
+    interface.fail_nodes(node_ids=[4, 8, 12, 16])
+    assert interface.get_node().get_first_alive_succ() is None
+
+    items = [(f"key {i}", i) for i in range(100)]
+    interface.insert_items(items[:50])
+    for item in items[50:]:
+        interface.insert_item(item)
+    interface.update_records([(key, -value) for key, value in items])
+    assert interface.get_items([key for key, _ in items]) == [-value for _, value in items]
+    assert len(list(interface.range_items(0, 31))) == 100
+    interface.delete_items([key for key, _ in items[:10]])
+
+    assert interface.heal() is not None
+    assert [interface.get_item(key) for key, _ in items] == [None] * 10 + [-value for _, value in items[10:]]
+
+def test_ring_config_is_not_shared(tmp_path):
+    ring = RingConfig(ks=16)
+    interface = Interface(ring)
+    interface.build_network(10, bulk=True)
+    with pytest.raises(ValueError):
+        ThreadSafeInterface(ring)
+    filename = str(tmp_path / "ring.snapshot")
+    snapshot.save(interface, filename)
+    with pytest.raises(ValueError):
+        snapshot.load(filename, ring=ring)
+    assert snapshot.load(filename, ring=RingConfig(ks=16)).sorted_ids == interface.sorted_ids
+
+@pytest.mark.parametrize("ks", [3, 8, 32, 160])
+def test_bulk_build_equals_joins(ks):
+    random.seed(ks)
+    ids = random.sample(range(1 << min(ks, 62)), min(40, 1 << ks))
+    joined = Interface(RingConfig(ks=ks))
+    joined.build_network(len(ids), ids)
+    built = Interface(RingConfig(ks=ks))
+    built.build_network(len(ids), ids, bulk=True)
+    assert built.check_ring(print_errors=True)
+    assert built.sorted_ids == joined.sorted_ids
+    assert tables(built) == tables(joined)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_range_items_brute_force(seed):
+    interface = network(32, 50, 2000, seed)
+    ring = interface.ring
+    positions = {f"key {i}": ring.hash_func(f"key {i}") for i in range(2000)}
+    rng = random.Random(seed)
+    for _ in range(20):
+        start, end = rng.randrange(ring.hs), rng.randrange(ring.hs)
+        span = ring.cw_dist(start, end)
+        expected = sorted((key for key, pos in positions.items() if ring.cw_dist(start, pos) <= span),
+                          key=lambda key: ring.cw_dist(start, positions[key]))
+        assert [key for key, _ in interface.range_items(start, end)] == expected
+        assert [key for key, _ in interface.range_items(start, end, limit=10)] == expected[:10]
+
+@pytest.mark.parametrize("seed", range(5))
+def test_knn_brute_force(seed):
+    interface = network(32, 200, 2000, seed)
+    ring = interface.ring
+    rng = random.Random(seed)
+    keys = [rng.randrange(ring.hs) for _ in range(20)] + rng.sample(interface.sorted_ids, 5)
+    for key in keys:
+        for k in (1, 7, 50):
+            expected = sorted(ring_distance(ring, key, node_id) for node_id in interface.nodes if node_id != key)
+            assert [ring_distance(ring, key, node.id) for node in interface.knn(k, key)] == expected[:k]
+
+            expected = sorted(ring_distance(ring, key, ring.hash_func(f"key {i}")) for i in range(2000))
+            nearest = interface.knn_items(k, key)
+            assert [ring_distance(ring, key, ring.hash_func(item)) for item, _ in nearest] == expected[:k]
+            assert all(value == int(item.split()[1]) for item, value in nearest)
+
+def test_threaded_scans_during_churn():
+    random.seed(0)
+    interface = ThreadSafeInterface(RingConfig(ks=32))
+    interface.build_network(300, bulk=True)
+    interface.bulk_load([f"key {i}" for i in range(3000)], list(range(3000)))
+    ring = interface.ring
+    done = threading.Event()
+    errors = []
+
+    def churn() -> None:
+        rng = random.Random(0)
+        try:
+            for _ in range(1000):
+                node_id = rng.randrange(ring.hs)
+                if node_id not in interface.nodes:
+                    interface.node_join(node_id)
+                    interface.node_leave(node_id)
+        finally:
+            done.set()
+
+    def scan(kind: int) -> None:
+        rng = random.Random(kind)
+        while not done.is_set():
+            pos = rng.randrange(ring.hs)
+            end = (pos + (1 << 28)) & ring.mask
+            try:
+                if kind == 0:
+                    assert len(interface.knn(5, pos)) == 5
+                elif kind == 1:
+                    list(interface.range_items(pos, end))
+                elif kind == 2:
+                    assert len(interface.knn_items(5, pos)) == 5
+                elif kind == 3:
+                    interface.range_query(pos, end)
+                else:
+                    keys = [f"key {rng.randrange(3000)}" for _ in range(20)]
+                    assert interface.get_items(keys) == [int(key.split()[1]) for key in keys]
+            except Exception as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=scan, args=(kind,)) for kind in range(5)] + [threading.Thread(target=churn)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert interface.check_ring(print_errors=True)
+
+def assert_same_network(loaded: Interface, saved: Interface) -> None:
+    assert loaded.sorted_ids == saved.sorted_ids
+    assert tables(loaded) == tables(saved)
+    assert loaded.check_ring(print_errors=True)
+
+def test_snapshot_round_trip(tmp_path):
+    interface = network(32, 200, 5000, 0, replicas=1)
+    filename = str(tmp_path / "ring.snapshot")
+    snapshot.save(interface, filename)
+
+    loaded = snapshot.load(filename)
+    assert_same_network(loaded, interface)
+    # Neither the items nor the replicas are decoded by the load
+    assert all(node.items.source is not None and node.replicas.source is not None
+               for node in loaded.nodes.values())
+    assert all(loaded.get_item(f"key {i}") == i for i in range(5000))
+
+    # A failed node's items are promoted from the (lazily built) replicas
+    loaded = snapshot.load(filename)
+    loaded.fail_nodes(node_ids=loaded.sorted_ids[:1])
+    loaded.heal()
+    assert loaded.check_ring(print_errors=True)
+    assert all(loaded.get_item(f"key {i}") == i for i in range(5000))
+
+    eager = snapshot.load(filename, lazy=False)
+    assert all(node.items.source is None for node in eager.nodes.values())
+    assert all(eager.get_item(f"key {i}") == i for i in range(5000))
+
+def test_snapshot_key_encoder(tmp_path):
+    random.seed(0)
+    items = parse_csv(DATA)
+    interface = Interface(RingConfig(ks=64, key_encoder=date_plot_encoder(64)))
+    interface.build_network(50, bulk=True)
+    interface.insert_all_data(items.items())
+    filename = str(tmp_path / "ring.snapshot")
+    snapshot.save(interface, filename)
+
+    with pytest.raises(ValueError):
+        snapshot.load(filename)
+    with pytest.raises(ValueError):
+        snapshot.load(filename, ring=RingConfig(ks=64))
+    loaded = snapshot.load(filename, ring=RingConfig(ks=64, key_encoder=date_plot_encoder(64)))
+    assert_same_network(loaded, interface)
+    assert all(loaded.get_item(key) == value for key, value in items.items())
+    start, end = sorted(items)[10], sorted(items)[100]
+    assert list(loaded.range_items(start, end)) == list(interface.range_items(start, end))
+
+def test_snapshot_schema_and_indexes(tmp_path):
+    random.seed(0)
+    items = parse_csv(DATA)
+    interface = Interface(RingConfig(ks=32, schema=RecordSchema()))
+    interface.build_network(50, bulk=True)
+    interface.insert_all_data(items.items())
+    interface.create_index("Experimental_treatment")
+    filename = str(tmp_path / "ring.snapshot")
+    snapshot.save(interface, filename)
+
+    loaded = snapshot.load(filename)
+    assert loaded.ring.schema is not None
+    assert loaded.indexes == interface.indexes
+    assert all(loaded.get_item(key) == value for key, value in items.items())
+    for treatment in {record["Experimental_treatment"] for record in items.values()}:
+        assert sorted(loaded.index_lookup("Experimental_treatment", treatment)) == \
+            sorted(interface.index_lookup("Experimental_treatment", treatment))
+    assert loaded.aggregate("Soil_NH4", "Block") == interface.aggregate("Soil_NH4", "Block")
@@ -0,0 +1,306 @@
+from interface import Interface, parse_csv
+from config import RingConfig
+from stats import percentile
+from time import perf_counter
+import argparse
+import json
+import random
+import sys
+
+# YCSB core workloads, as op -> fraction of the operations.
+# E scans from a key, K is a kNN variant of E.
+WORKLOADS = {
+    "A": {"read": 0.5, "update": 0.5},
+    "B": {"read": 0.95, "update": 0.05},
+    "C": {"read": 1.0},
+    "D": {"read": 0.95, "insert": 0.05},
+    "E": {"range": 0.95, "insert": 0.05},
+    "K": {"knn": 0.95, "insert": 0.05},
+    "churn": {"read": 0.4, "update": 0.2, "insert": 0.2, "delete": 0.2},
+}
+DISTRIBUTIONS = ("uniform", "zipfian", "hotspot")
+
+class ZipfianGenerator:
+    """Item ranks in [0, n) with P(rank i) ∝ 1 / (i + 1)^theta, as YCSB's
+    generator (Gray et al., "Quickly generating billion-record synthetic
+    databases"). n can grow as items are inserted."""
+
+    def __init__(self, n: int, theta: float = 0.99) -> None:
+        self.theta = theta
+        self.alpha = 1 / (1 - theta)
+        self.zeta2 = 1 + 0.5 ** theta
+        self.n = 0
+        self.zetan = 0.0
+        self.resize(n)
+
+    def resize(self, n: int) -> None:
+        """Resizes the range to [0, n), updating zeta(n) term by term."""
+
+        if n > self.n:
+            self.zetan += sum(1 / i ** self.theta for i in range(self.n + 1, n + 1))
+        else:
+            self.zetan -= sum(1 / i ** self.theta for i in range(n + 1, self.n + 1))
+        self.n = n
+        self.eta = (1 - (2 / n) ** (1 - self.theta)) / (1 - self.zeta2 / self.zetan) if n > 1 else 0.0
+
+    def next(self, rng: random.Random) -> int:
+        u = rng.random()
+        uz = u * self.zetan
+        if uz < 1 or self.n == 1:
+            return 0
+        if uz < self.zeta2:
+            return 1
+        return min(int(self.n * (self.eta * u - self.eta + 1) ** self.alpha), self.n - 1)
+
+class KeyChooser:
+    """Picks existing keys with a uniform, Zipfian or hotspot
+    distribution over their ranks. Keys are ranked in the (shuffled)
+    order they were added, so the hot keys are spread over the ring."""
+
+    def __init__(self, keys: list[str], distribution: str = "uniform", theta: float = 0.99,
+                 hot_fraction: float = 0.2, hot_ops: float = 0.8) -> None:
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Distribution must be one of {DISTRIBUTIONS}, got {distribution}.")
+        self.keys = list(keys)
+        self.distribution = distribution
+        # hot_ops of the operations go to the first hot_fraction of the keys
+        self.hot_fraction = hot_fraction
+        self.hot_ops = hot_ops
+        self.zipfian = ZipfianGenerator(max(len(self.keys), 1), theta) if distribution == "zipfian" else None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key: str) -> None:
+        self.keys.append(key)
+        if self.zipfian is not None:
+            self.zipfian.resize(len(self.keys))
+
+    def remove(self, key: str) -> None:
+        # The last key takes the removed key's rank
+        i = self.keys.index(key)
+        self.keys[i] = self.keys[-1]
+        self.keys.pop()
+        if self.zipfian is not None and self.keys:
+            self.zipfian.resize(len(self.keys))
+
+    def choose(self, rng: random.Random) -> str:
+        n = len(self.keys)
+        if self.distribution == "zipfian":
+            return self.keys[self.zipfian.next(rng)]
+        if self.distribution == "hotspot":
+            hot = max(1, int(n * self.hot_fraction))
+            if rng.random() < self.hot_ops or hot == n:
+                return self.keys[rng.randrange(hot)]
+            return self.keys[rng.randrange(hot, n)]
+        return self.keys[rng.randrange(n)]
+
+def generate(operation_count: int = 10_000, workload: str = "A", distribution: str = "uniform",
+             node_count: int = 100, ks: int = 32, seed: int = 0, churn: dict = None, heal_after: int = 50,
+             scan_length: int = 10, data: str = "NH4_NO3.csv", **chooser_options) -> dict:
+    """Generates a trace: the network to build and the operations and
+    membership events to run on it, all derived from seed.
+
+    churn maps join/leave/fail to their probability after each
+    operation. A failure is healed heal_after operations later, and no
+    other event happens in between. Inserted keys are new plots of the
+    csv dates, so they also fit a date_plot_encoder ring."""
+
+    if workload not in WORKLOADS:
+        raise ValueError(f"Workload must be one of {tuple(WORKLOADS)}, got {workload}.")
+    rng = random.Random(seed)
+    churn = churn or {}
+    items = parse_csv(data)
+    records = list(items.values())
+    keys = sorted(items)
+    rng.shuffle(keys)
+    node_ids = sorted(rng.sample(range(1 << ks), node_count))
+    chooser = KeyChooser(keys, distribution, **chooser_options)
+    ops, weights = zip(*WORKLOADS[workload].items())
+    dates = sorted({record["Date"] for record in records})
+    live_nodes = list(node_ids)
+    next_plot = 1000
+    heal_at = None
+
+    def new_record(key: str) -> dict:
+        record = dict(rng.choice(records))
+        record["Date"], plot = key.split("_")
+        record["Plot"] = int(plot)
+        record["Soil_NH4"] = round(rng.uniform(0, 30), 2)
+        return record
+
+    events = []
+    for i in range(operation_count):
+        op = rng.choices(ops, weights)[0]
+        # Nothing left to read, update or delete
+        if op not in ("insert", "range", "knn") and not chooser:
+            op = "insert"
+        if op == "insert":
+            key = f"{rng.choice(dates)}_{next_plot}"
+            next_plot += 1
+            chooser.add(key)
+            events.append([op, [key, new_record(key)]])
+        elif op == "update":
+            key = chooser.choose(rng)
+            events.append([op, [key, new_record(key)]])
+        elif op == "delete":
+            key = chooser.choose(rng)
+            chooser.remove(key)
+            events.append([op, key])
+        elif op in ("range", "knn"):
+            events.append([op, [chooser.choose(rng) if chooser else keys[0], scan_length]])
+        else:
+            events.append([op, chooser.choose(rng)])
+
+        if heal_at is not None:
+            if i == heal_at:
+                events.append(["heal", None])
+                heal_at = None
+            continue
+        for event in ("join", "leave", "fail"):
+            if rng.random() >= churn.get(event, 0):
+                continue
+            if event == "join":
+                node_id = rng.randrange(1 << ks)
+                if node_id not in live_nodes:
+                    live_nodes.append(node_id)
+                    events.append([event, node_id])
+            elif len(live_nodes) > 1:
+                node_id = live_nodes.pop(rng.randrange(len(live_nodes)))
+                events.append([event, node_id])
+                if event == "fail":
+                    heal_at = i + heal_after
+                    break
+
+    return {
+        "header": {"seed": seed, "workload": workload, "distribution": distribution, "ks": ks,
+                   "data": data, "node_ids": node_ids},
+        "events": events,
+    }
+
+def save_trace(trace: dict, filename: str) -> None:
+    """Writes a trace as JSON lines, the header first."""
+
+    with open(filename, "w") as f:
+        f.write(json.dumps(trace["header"]) + "\n")
+        for event in trace["events"]:
+            f.write(json.dumps(event) + "\n")
+
+def load_trace(filename: str) -> dict:
+    with open(filename) as f:
+        header = json.loads(f.readline())
+        return {"header": header, "events": [json.loads(line) for line in f if line.strip()]}
+
+def build(trace: dict, ring: RingConfig = None) -> Interface:
+    """The trace's starting network with the csv items loaded."""
+
+    header = trace["header"]
+    interface = Interface(ring if ring is not None else RingConfig(ks=header["ks"]))
+    interface.build_network(len(header["node_ids"]), header["node_ids"], bulk=True)
+    interface.insert_all_data(parse_csv(header["data"]).items())
+    return interface
+
+def replay(trace: dict, interface: Interface = None) -> dict:
+    """Runs a trace's events in order on interface (by default the
+    network built from its header). Returns the throughput, latency
+    percentiles and misses (reads that found nothing) of every op."""
+
+    if interface is None:
+        interface = build(trace)
+    mask = interface.ring.mask
+    hash_func = interface.ring.hash_func
+
+    def run(op: str, argument):
+        if op == "read":
+            return interface.get_item(argument)
+        if op == "insert":
+            return interface.insert_item(tuple(argument))
+        if op == "update":
+            return interface.update_record(tuple(argument))
+        if op == "delete":
+            return interface.delete_item(argument)
+        if op == "range":
+            # Scan of argument[1] items from the key's position
+            pos = hash_func(argument[0])
+            return list(interface.range_items(pos, (pos - 1) & mask, limit=argument[1]))
+        if op == "knn":
+            return interface.knn_items(argument[1], hash_func(argument[0]))
+        if op == "join":
+            return interface.node_join(argument)
+        if op == "leave":
+            return interface.node_leave(argument)
+        if op == "fail":
+            return interface.fail_nodes(node_ids=[argument])
+        if op == "heal":
+            return interface.heal()
+        raise ValueError(f"Unknown trace op {op}.")
+
+    latencies = {}
+    misses = {}
+    start = perf_counter()
+    for op, argument in trace["events"]:
+        op_start = perf_counter()
+        result = run(op, argument)
+        latencies.setdefault(op, []).append(perf_counter() - op_start)
+        if op == "read" and result is None:
+            misses[op] = misses.get(op, 0) + 1
+    seconds = perf_counter() - start
+
+    report = {}
+    for op, values in latencies.items():
+        total = sum(values)
+        values.sort()
+        report[op] = {
+            "count": len(values),
+            "ops_per_sec": len(values) / total if total else 0.0,
+            "mean_ms": total / len(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "misses": misses.get(op, 0),
+        }
+    return {"events": len(trace["events"]), "seconds": seconds,
+            "ops_per_sec": len(trace["events"]) / seconds, "ops": report}
+
+def report_print(report: dict) -> None:
+    print(f"{report['events']} events in {report['seconds']:.2f}s ({report['ops_per_sec']:.0f} ops/s)")
+    for op, row in report["ops"].items():
+        print(f"{op:8} {row['count']:7} ops {row['ops_per_sec']:10.0f} ops/s  p50 {row['p50_ms']:.3f} ms  "
+              f"p95 {row['p95_ms']:.3f} ms  p99 {row['p99_ms']:.3f} ms  misses {row['misses']}")
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="YCSB-style workloads with churn, recorded and replayed as traces.")
+    parser.add_argument("--workload", default="A", choices=WORKLOADS)
+    parser.add_argument("--distribution", default="uniform", choices=DISTRIBUTIONS)
+    parser.add_argument("--operations", type=int, default=10_000)
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data", default="NH4_NO3.csv", help="csv dataset")
+    for event in ("join", "leave", "fail"):
+        parser.add_argument(f"--{event}", type=float, default=0.0, help=f"{event} probability per operation")
+    parser.add_argument("--replicas", type=int, default=0, help="copies kept on successors, so failures lose no items")
+    parser.add_argument("--record", metavar="FILE", help="save the generated trace")
+    parser.add_argument("--replay", metavar="FILE", help="replay a saved trace instead of generating one")
+    parser.add_argument("--json", help="write the report to this JSON file")
+    return parser.parse_args(argv)
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(argv)
+    if args.replay:
+        trace = load_trace(args.replay)
+    else:
+        trace = generate(args.operations, args.workload, args.distribution, args.nodes, seed=args.seed,
+                         churn={"join": args.join, "leave": args.leave, "fail": args.fail}, data=args.data)
+    if args.record:
+        save_trace(trace, args.record)
+    random.seed(trace["header"]["seed"])
+    report = replay(trace, build(trace, RingConfig(ks=trace["header"]["ks"], replicas=args.replicas)))
+    report_print(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"header": {k: v for k, v in trace["header"].items() if k != "node_ids"},
+                       "report": report}, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())